@@ -0,0 +1,100 @@
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import motor.motor_asyncio
+from bson import ObjectId
+
+from conversations import conversation_id_for
+from indexes import apply_indexes
+from search import SearchIndex, search_messages
+
+# Seeds a separate database so the real chat_app data is never touched
+BENCH_DATABASE = "chat_app_bench"
+MESSAGES = int(os.getenv("BENCH_MESSAGES", "2000000"))
+USERS = int(os.getenv("BENCH_USERS", "20000"))
+ADMINS = int(os.getenv("BENCH_ADMINS", "50"))
+# Admins each customer talks to
+PEERS_PER_CUSTOMER = 3
+QUERIES = int(os.getenv("BENCH_QUERIES", "500"))
+INSERT_BATCH = 5000
+
+VOCABULARY = [f"word{i}" for i in range(20000)]
+
+def zipf_word(rng: random.Random) -> str:
+    # Rough Zipf distribution so some terms are common and most are rare
+    return VOCABULARY[min(int(rng.paretovariate(1.1)) - 1, len(VOCABULARY) - 1)]
+
+async def seed(db, search_index: SearchIndex, rng: random.Random):
+    collection = db.messages
+    if await collection.estimated_document_count() >= MESSAGES:
+        print(f"Reusing existing corpus of {await collection.estimated_document_count()} messages")
+        return
+    for name in ("messages", "users", "search_entries"):
+        await db[name].drop()
+    customers = [str(ObjectId()) for _ in range(USERS)]
+    admins = [str(ObjectId()) for _ in range(ADMINS)]
+    await db.users.insert_many([{"_id": user_id, "role": "customer"} for user_id in customers] +
+                               [{"_id": user_id, "role": "admin"} for user_id in admins])
+    peers = {customer: rng.sample(admins, PEERS_PER_CUSTOMER) for customer in customers}
+    start = datetime(2024, 1, 1)
+    print(f"Seeding {MESSAGES} messages between {USERS} customers and {ADMINS} admins...")
+    for offset in range(0, MESSAGES, INSERT_BATCH):
+        batch = []
+        for i in range(offset, min(offset + INSERT_BATCH, MESSAGES)):
+            customer = rng.choice(customers)
+            sender, receiver = rng.sample([customer, rng.choice(peers[customer])], 2)
+            conversation_id = conversation_id_for(sender, receiver)
+            batch.append({
+                "conversation_id": conversation_id,
+                "sender_id": sender,
+                "receiver_id": receiver,
+                "content": " ".join(zipf_word(rng) for _ in range(rng.randint(3, 20))),
+                "timestamp": (start + timedelta(seconds=i)).isoformat(),
+                "status": "sent",
+                "is_read": False
+            })
+        await collection.insert_many(batch, ordered=False)
+        # What the message writer listener does for every persisted batch
+        await search_index.on_messages(batch)
+        if offset % (INSERT_BATCH * 40) == 0:
+            print(f"   {offset + len(batch)} inserted")
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+async def run():
+    rng = random.Random(42)
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    db = client[BENCH_DATABASE]
+    search_index = SearchIndex(db.search_entries)
+    await seed(db, search_index, rng)
+    print("Applying indexes...")
+    await apply_indexes(db)
+
+    customers = await db.users.distinct("_id", {"role": "customer"})
+    admins = await db.users.distinct("_id", {"role": "admin"})
+    scenarios = {
+        "admin (all messages)": lambda: None,
+        f"customer ({PEERS_PER_CUSTOMER} conversations)": lambda: rng.choice(customers),
+        f"admin (~{USERS * PEERS_PER_CUSTOMER // ADMINS} conversations)": lambda: rng.choice(admins),
+    }
+    for name, participant in scenarios.items():
+        latencies = []
+        for _ in range(QUERIES):
+            terms = " ".join(zipf_word(rng) for _ in range(rng.randint(1, 3)))
+            started = time.perf_counter()
+            await search_messages(db.messages, search_index, terms, participant(), limit=20)
+            latencies.append((time.perf_counter() - started) * 1000)
+        print(f"{name:<30} p50 {percentile(latencies, 50):7.1f} ms   "
+              f"p90 {percentile(latencies, 90):7.1f} ms   p99 {percentile(latencies, 99):7.1f} ms")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        print("Usage: BENCH_MESSAGES=2000000 python bench_search.py")
+        sys.exit(1)
+    asyncio.run(run())
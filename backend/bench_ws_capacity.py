@@ -0,0 +1,103 @@
+import asyncio
+import os
+import resource
+import sys
+import time
+import uuid
+
+import msgpack
+import requests
+import websockets
+
+from ws_protocol import V2_SUBPROTOCOL
+
+# Run against a single worker: uvicorn main:app --workers 1
+API_URL = os.getenv("BENCH_API_URL", "http://localhost:8000")
+WS_URL = API_URL.replace("http", "ws", 1)
+IDLE = int(os.getenv("BENCH_IDLE", "5000"))
+ACTIVE_PAIRS = int(os.getenv("BENCH_ACTIVE_PAIRS", "200"))
+RATE = float(os.getenv("BENCH_RATE", "1.0"))  # messages per second per active sender
+DURATION = float(os.getenv("BENCH_DURATION", "30"))
+P99_BUDGET_MS = float(os.getenv("BENCH_P99_BUDGET_MS", "100"))
+CONNECT_CONCURRENCY = 200
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+async def connect(user_id: str, gate: asyncio.Semaphore):
+    async with gate:
+        return await websockets.connect(f"{WS_URL}/ws/chat/{user_id}", subprotocols=[V2_SUBPROTOCOL],
+                                        max_queue=None, ping_interval=None)
+
+async def receive_loop(websocket, sent_at: dict, latencies: list):
+    async for frame in websocket:
+        for event in msgpack.unpackb(frame, raw=False):
+            if event["type"] == "ping":
+                await websocket.send(msgpack.packb({"type": "pong", "ts": event["ts"]}))
+            elif event["type"] == "message" and event["message"] in sent_at:
+                latencies.append((time.perf_counter() - sent_at.pop(event["message"])) * 1000)
+
+async def send_loop(websocket, recipient_id: str, sent_at: dict, deadline: float):
+    while time.perf_counter() < deadline:
+        token = uuid.uuid4().hex
+        sent_at[token] = time.perf_counter()
+        await websocket.send(msgpack.packb({"type": "chat", "recipient_id": recipient_id, "message": token}))
+        await asyncio.sleep(1 / RATE)
+
+def admin_metrics(admin_email: str, admin_password: str) -> dict:
+    response = requests.post(f"{API_URL}/api/auth/login", json={"email": admin_email, "password": admin_password})
+    response.raise_for_status()
+    token = response.json()["access_token"]
+    response = requests.get(f"{API_URL}/api/admin/metrics", headers={"Authorization": f"Bearer {token}"})
+    response.raise_for_status()
+    return response.json()["outbound"]
+
+async def run(admin_email: str = None, admin_password: str = None):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < IDLE + 2 * ACTIVE_PAIRS + 100:
+        print(f"Open file limit is {soft}; raise it with ulimit -n on both client and server")
+
+    gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    run_id = uuid.uuid4().hex[:8]
+    print(f"Opening {IDLE} idle connections...")
+    started = time.perf_counter()
+    idle = await asyncio.gather(*(connect(f"bench-{run_id}-idle-{i}", gate) for i in range(IDLE)),
+                                return_exceptions=True)
+    idle_ok = [ws for ws in idle if not isinstance(ws, Exception)]
+    print(f"   {len(idle_ok)} open, {len(idle) - len(idle_ok)} refused in {time.perf_counter() - started:.1f}s")
+
+    print(f"Opening {ACTIVE_PAIRS} sender/receiver pairs...")
+    senders = await asyncio.gather(*(connect(f"bench-{run_id}-s-{i}", gate) for i in range(ACTIVE_PAIRS)))
+    receivers = await asyncio.gather(*(connect(f"bench-{run_id}-r-{i}", gate) for i in range(ACTIVE_PAIRS)))
+
+    sent_at, latencies = {}, []
+    listeners = [asyncio.create_task(receive_loop(ws, sent_at, latencies)) for ws in idle_ok + receivers + senders]
+    deadline = time.perf_counter() + DURATION
+    print(f"Sending {RATE} msg/s per pair for {DURATION:.0f}s...")
+    await asyncio.gather(*(send_loop(ws, f"bench-{run_id}-r-{i}", sent_at, deadline) for i, ws in enumerate(senders)))
+    await asyncio.sleep(2)
+
+    if latencies:
+        p99 = percentile(latencies, 99)
+        print(f"Delivered {len(latencies)} messages, lost {len(sent_at)}: p50 {percentile(latencies, 50):.1f} ms   "
+              f"p90 {percentile(latencies, 90):.1f} ms   p99 {p99:.1f} ms "
+              f"({'within' if p99 <= P99_BUDGET_MS else 'OVER'} the {P99_BUDGET_MS:.0f} ms budget)")
+    else:
+        print("No messages were delivered")
+
+    if admin_email:
+        outbound = admin_metrics(admin_email, admin_password)
+        memory = outbound["memory"]
+        print(f"Server: {outbound['connections']} connections, {outbound['rejected']} rejected, "
+              f"RSS {memory['rss_bytes'] / 2**20:.0f} MiB, ~{(memory['rss_per_connection'] or 0) / 1024:.1f} KiB per connection")
+
+    for task in listeners:
+        task.cancel()
+    await asyncio.gather(*(ws.close() for ws in idle_ok + senders + receivers), return_exceptions=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (1, 3):
+        print("Usage: BENCH_IDLE=5000 BENCH_ACTIVE_PAIRS=200 python bench_ws_capacity.py [<admin_email> <admin_password>]")
+        sys.exit(1)
+    asyncio.run(run(*sys.argv[1:]))
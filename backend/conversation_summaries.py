@@ -0,0 +1,164 @@
+"""Materialized per-user conversation summaries backing the inbox.
+
+Each participant of a conversation has one summary holding the last message
+and their unread count. Summaries are updated from persisted message batches
+and flushed read cursors, so the inbox is a single indexed range read.
+
+    python conversation_summaries.py rebuild   # build summaries from existing messages
+"""
+import asyncio
+import logging
+import os
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import motor.motor_asyncio
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 200
+
+
+def summary_id(user_id: str, conversation_id: str) -> str:
+    return f"{user_id}|{conversation_id}"
+
+
+def _peer_of(conversation_id: str, user_id: str) -> str:
+    first, second = conversation_id.split(":", 1)
+    return second if first == user_id else first
+
+
+def _summary_update(user_id: str, conversation_id: str, last: dict, unread_delta: int, last_seq: int) -> UpdateOne:
+    preview = {
+        "_id": str(last["_id"]),
+        "sender_id": last["sender_id"],
+        "content": last["content"][:PREVIEW_LENGTH],
+        "timestamp": last["timestamp"],
+    }
+    timestamp = last["timestamp"]
+    # Pipeline update so batches arriving out of order never move last_message backwards
+    return UpdateOne(
+        {"_id": summary_id(user_id, conversation_id)},
+        [{"$set": {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            "peer_id": _peer_of(conversation_id, user_id),
+            "last_message": {"$cond": [
+                {"$gt": [timestamp, {"$ifNull": ["$last_message_at", ""]}]},
+                {"$literal": preview},
+                "$last_message"
+            ]},
+            "last_message_at": {"$max": ["$last_message_at", timestamp]},
+            "unread_count": {"$add": [{"$ifNull": ["$unread_count", 0]}, unread_delta]},
+            "last_seq": {"$max": [{"$ifNull": ["$last_seq", 0]}, last_seq]},
+        }}],
+        upsert=True
+    )
+
+
+class ConversationSummaries:
+    def __init__(self, collection, messages_collection, read_cursors):
+        self.collection = collection
+        self.messages_collection = messages_collection
+        self.read_cursors = read_cursors
+
+    async def on_messages(self, messages: List[dict]):
+        """Message writer listener: fold a persisted batch into both participants' summaries."""
+        latest: Dict[str, dict] = {}
+        received: Dict[Tuple[str, str], int] = defaultdict(int)
+        last_seq: Dict[str, int] = defaultdict(int)
+        for message in messages:
+            conversation_id = message.get("conversation_id")
+            if not conversation_id:
+                continue
+            if conversation_id not in latest or message["timestamp"] >= latest[conversation_id]["timestamp"]:
+                latest[conversation_id] = message
+            received[(message["receiver_id"], conversation_id)] += 1
+            last_seq[conversation_id] = max(last_seq[conversation_id], message.get("seq") or 0)
+
+        operations = []
+        for conversation_id, last in latest.items():
+            for user_id in conversation_id.split(":", 1):
+                operations.append(_summary_update(user_id, conversation_id, last,
+                                                  received.get((user_id, conversation_id), 0),
+                                                  last_seq[conversation_id]))
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+
+    async def _count_unread(self, user_id: str, conversation_id: str, read_up_to: str) -> int:
+        return await self.messages_collection.count_documents({
+            "conversation_id": conversation_id,
+            "timestamp": {"$gt": read_up_to},
+            "receiver_id": user_id,
+            "is_read": {"$ne": True}
+        })
+
+    async def on_read(self, cursors: Dict[Tuple[str, str], str]):
+        """Read cursor listener: recount unread messages after the new cursor."""
+        operations = []
+        for (reader_id, conversation_id), read_up_to in cursors.items():
+            unread = await self._count_unread(reader_id, conversation_id, read_up_to)
+            operations.append(UpdateOne(
+                {"_id": summary_id(reader_id, conversation_id)},
+                {"$set": {"unread_count": unread}}
+            ))
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+
+    async def rebuild(self) -> int:
+        """Recompute every summary from the messages collection."""
+        rebuilt = 0
+        pipeline = [
+            {"$match": {"conversation_id": {"$exists": True}}},
+            {"$sort": {"conversation_id": 1, "timestamp": 1}},
+            {"$group": {
+                "_id": "$conversation_id",
+                "last": {"$last": {"_id": "$_id", "sender_id": "$sender_id",
+                                   "content": "$content", "timestamp": "$timestamp"}},
+                "last_seq": {"$max": "$seq"},
+            }},
+        ]
+        async for group in self.messages_collection.aggregate(pipeline, allowDiskUse=True):
+            conversation_id, last = group["_id"], group["last"]
+            participants = conversation_id.split(":", 1)
+            cursors = await self.read_cursors.get_cursors((user_id, conversation_id) for user_id in participants)
+            operations = []
+            for user_id in participants:
+                unread = await self._count_unread(user_id, conversation_id, cursors.get((user_id, conversation_id), ""))
+                operations.append(UpdateOne(
+                    {"_id": summary_id(user_id, conversation_id)},
+                    {"$set": {
+                        "user_id": user_id,
+                        "conversation_id": conversation_id,
+                        "peer_id": _peer_of(conversation_id, user_id),
+                        "last_message": {**last, "_id": str(last["_id"]), "content": last["content"][:PREVIEW_LENGTH]},
+                        "last_message_at": last["timestamp"],
+                        "unread_count": unread,
+                        "last_seq": group["last_seq"] or 0,
+                    }},
+                    upsert=True
+                ))
+            await self.collection.bulk_write(operations, ordered=False)
+            rebuilt += 1
+        return rebuilt
+
+
+async def main(argv) -> int:
+    if argv != ["rebuild"]:
+        print("Usage: python conversation_summaries.py rebuild")
+        return 1
+    from read_cursors import ReadCursorStore
+
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    db = client.chat_app
+    summaries = ConversationSummaries(db.conversation_summaries, db.messages, ReadCursorStore(db.read_cursors))
+    rebuilt = await summaries.rebuild()
+    print(f"Rebuilt summaries for {rebuilt} conversations")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -0,0 +1,59 @@
+"""Conversation keys for one-to-one messages.
+
+    python conversations.py backfill   # add conversation_id to older messages
+"""
+import asyncio
+import logging
+import os
+import sys
+
+import motor.motor_asyncio
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def conversation_id_for(user_a, user_b) -> str:
+    """Canonical key for the conversation between two users, independent of direction."""
+    first, second = sorted((str(user_a), str(user_b)))
+    return f"{first}:{second}"
+
+
+async def backfill_conversation_ids(messages_collection, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    updated = 0
+    operations = []
+    cursor = messages_collection.find(
+        {"conversation_id": {"$exists": False}},
+        {"sender_id": 1, "receiver_id": 1}
+    ).batch_size(batch_size)
+    async for message in cursor:
+        operations.append(UpdateOne(
+            {"_id": message["_id"]},
+            {"$set": {"conversation_id": conversation_id_for(message["sender_id"], message["receiver_id"])}}
+        ))
+        if len(operations) >= batch_size:
+            result = await messages_collection.bulk_write(operations, ordered=False)
+            updated += result.modified_count
+            operations = []
+            logger.info(f"Backfilled {updated} messages")
+    if operations:
+        result = await messages_collection.bulk_write(operations, ordered=False)
+        updated += result.modified_count
+    return updated
+
+
+async def main(argv) -> int:
+    if argv != ["backfill"]:
+        print("Usage: python conversations.py backfill")
+        return 1
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    updated = await backfill_conversation_ids(client.chat_app.messages)
+    print(f"Added conversation_id to {updated} messages")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
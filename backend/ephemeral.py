@@ -0,0 +1,119 @@
+"""Non-persistent WebSocket events: typing indicators and presence pings.
+
+These events go straight to the message router and never touch MongoDB.
+Each sender gets at most one event per conversation (typing) or one status
+ping (presence) per ``EPHEMERAL_INTERVAL`` seconds. Updates arriving in
+between replace each other and the latest one goes out when the interval
+ends, so a final "stopped typing" is never lost.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Set, Tuple, Union
+
+from conversations import conversation_id_for
+
+logger = logging.getLogger(__name__)
+
+EPHEMERAL_INTERVAL = float(os.getenv("EPHEMERAL_INTERVAL", "2"))
+EPHEMERAL_TYPES = ("typing", "presence")
+PRESENCE_STATUSES = ("online", "away")
+PRESENCE_MAX_PEERS = 100
+
+# (sender, conversation_id) for typing, (sender, "presence") for status pings
+Key = Tuple[str, str]
+# One recipient or a list of them, and the event
+Pending = Tuple[Union[str, List[str]], dict]
+
+
+class EphemeralLane:
+    def __init__(self, router, interval: float = EPHEMERAL_INTERVAL):
+        self.router = router
+        self.interval = interval
+        self._last_sent: Dict[Key, float] = {}
+        self._pending: Dict[Key, Pending] = {}
+        self._timers: Dict[Key, asyncio.TimerHandle] = {}
+        # Sends started from timers; held here so they are not collected mid-flight
+        self._sends: Set[asyncio.Task] = set()
+        self._last_prune = time.monotonic()
+        self._stats = {"sent": 0, "coalesced": 0, "invalid": 0}
+
+    async def stop(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._pending.clear()
+        # _send logs its own failures, so this only waits for the trailing events
+        await asyncio.gather(*self._sends)
+
+    async def handle(self, sender_id: str, data: dict):
+        """Validate an ephemeral frame and forward it; raises ValueError for malformed frames."""
+        if data.get("type") == "typing":
+            peer_id = data.get("peer_id")
+            if not isinstance(peer_id, str) or not peer_id or not isinstance(data.get("typing", True), bool):
+                self._stats["invalid"] += 1
+                raise ValueError("typing needs a peer_id and an optional boolean typing")
+            conversation_id = conversation_id_for(sender_id, peer_id)
+            event = {"type": "typing", "from": sender_id, "conversation_id": conversation_id,
+                     "typing": data.get("typing", True)}
+            await self._submit((sender_id, conversation_id), (peer_id, event))
+        else:
+            peer_ids = data.get("peer_ids")
+            if not isinstance(peer_ids, list) or not 0 < len(peer_ids) <= PRESENCE_MAX_PEERS \
+                    or not all(isinstance(peer_id, str) for peer_id in peer_ids) \
+                    or data.get("status") not in PRESENCE_STATUSES:
+                self._stats["invalid"] += 1
+                raise ValueError(f"presence needs up to {PRESENCE_MAX_PEERS} peer_ids and a status of "
+                                 f"{' or '.join(PRESENCE_STATUSES)}")
+            event = {"type": "presence", "from": sender_id, "status": data["status"]}
+            await self._submit((sender_id, "presence"), (peer_ids, event))
+
+    async def _submit(self, key: Key, pending: Pending):
+        now = time.monotonic()
+        self._prune(now)
+        last = self._last_sent.get(key)
+        if key not in self._timers and (last is None or now - last >= self.interval):
+            self._last_sent[key] = now
+            await self._send(pending)
+            return
+        # Inside the interval: keep only the latest update and send it when the interval ends
+        if key in self._pending:
+            self._stats["coalesced"] += 1
+        self._pending[key] = pending
+        if key not in self._timers:
+            delay = self.interval - (now - last)
+            self._timers[key] = asyncio.get_running_loop().call_later(delay, self._flush, key)
+
+    def _flush(self, key: Key):
+        self._timers.pop(key, None)
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            self._last_sent[key] = time.monotonic()
+            task = asyncio.create_task(self._send(pending))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, pending: Pending):
+        recipients, event = pending
+        try:
+            if isinstance(recipients, str):
+                await self.router.publish(recipients, event)
+            else:
+                await self.router.fan_out(event, recipients, exclude={event["from"]})
+            self._stats["sent"] += 1
+        except Exception as e:
+            logger.error(f"Failed to send {event['type']} event from {event['from']}: {e}")
+
+    def _prune(self, now: float):
+        # Entries older than one interval no longer throttle anything
+        if now - self._last_prune < self.interval:
+            return
+        self._last_prune = now
+        for key, sent_at in list(self._last_sent.items()):
+            if now - sent_at >= self.interval:
+                del self._last_sent[key]
+
+    def metrics(self) -> dict:
+        return {**self._stats, "interval": self.interval, "tracked": len(self._last_sent),
+                "pending": len(self._pending)}
@@ -0,0 +1,154 @@
+"""Streaming NDJSON export of users and messages.
+
+Documents are written in ``_id`` order as MongoDB extended JSON, one per line.
+Every batch is compressed as its own gzip member; concatenated members are a
+valid gzip file, so an interrupted export can be truncated to the last
+complete batch and continued from the ``_id`` recorded for it.
+
+Messages are exported from the hot collection first and then from the cold
+archive, one gzip member per block. Archived lines carry ``_archive_block``;
+resume tokens in that phase are ``archive:<block id>``. A message compacted
+while an export runs may appear in both phases.
+
+    python export.py messages messages.ndjson.gz [--resume]
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import sys
+from typing import AsyncIterator, Optional, Tuple
+
+import motor.motor_asyncio
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from bson.json_util import RELAXED_JSON_OPTIONS
+
+from message_archive import decode_block
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+EXPORT_COMPRESS_LEVEL = int(os.getenv("EXPORT_COMPRESS_LEVEL", "6"))
+
+# Collection name -> projection
+EXPORTS = {
+    "users": {"password": 0},
+    "messages": None,
+}
+
+# Collection name -> cold archive collection exported after it
+ARCHIVES = {
+    "messages": "messages_cold",
+}
+
+ARCHIVE_TOKEN_PREFIX = "archive:"
+
+# (tier, _id) where tier is "hot" or "archive"
+ResumePosition = Tuple[str, ObjectId]
+
+
+def parse_resume_token(after: Optional[str]) -> Optional[ResumePosition]:
+    if not after:
+        return None
+    tier = "hot"
+    if after.startswith(ARCHIVE_TOKEN_PREFIX):
+        tier, after = "archive", after[len(ARCHIVE_TOKEN_PREFIX):]
+    try:
+        return tier, ObjectId(after)
+    except (InvalidId, TypeError):
+        raise ValueError("Invalid resume token")
+
+
+def _member(lines) -> bytes:
+    return gzip.compress(("\n".join(lines) + "\n").encode(), EXPORT_COMPRESS_LEVEL)
+
+
+async def export_batches(collection, projection: Optional[dict] = None, after: Optional[ResumePosition] = None,
+                         batch_size: int = EXPORT_BATCH_SIZE,
+                         archive=None) -> AsyncIterator[Tuple[bytes, str]]:
+    """Yield ``(gzip_member, resume_token)`` for each batch of documents after ``after``.
+
+    With an ``archive`` collection the cold blocks follow the hot documents.
+    """
+    if after is None or after[0] == "hot":
+        query = {"_id": {"$gt": after[1]}} if after else {}
+        cursor = collection.find(query, projection).sort("_id", 1).batch_size(batch_size)
+        lines = []
+        last_id = None
+        async for document in cursor:
+            lines.append(json_util.dumps(document, json_options=RELAXED_JSON_OPTIONS))
+            last_id = document["_id"]
+            if len(lines) >= batch_size:
+                yield _member(lines), str(last_id)
+                lines = []
+        if lines:
+            yield _member(lines), str(last_id)
+
+    if archive is None:
+        return
+    query = {"_id": {"$gt": after[1]}} if after and after[0] == "archive" else {}
+    async for block in archive.find(query, {"message_ids": 0}).sort("_id", 1):
+        lines = [
+            json_util.dumps({**message, "_archive_block": block["_id"]}, json_options=RELAXED_JSON_OPTIONS)
+            for message in decode_block(block)
+        ]
+        yield _member(lines), f"{ARCHIVE_TOKEN_PREFIX}{block['_id']}"
+
+
+async def export_stream(collection, projection: Optional[dict] = None,
+                        after: Optional[ResumePosition] = None, archive=None) -> AsyncIterator[bytes]:
+    async for member, _ in export_batches(collection, projection, after, archive=archive):
+        yield member
+
+
+async def export_to_file(collection, projection: Optional[dict], path: str, resume: bool = False,
+                         archive=None) -> int:
+    """Export into ``path``; with ``resume`` continue from the ``path.resume`` checkpoint."""
+    checkpoint_path = f"{path}.resume"
+    after = None
+    offset = 0
+    if resume and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        after = parse_resume_token(checkpoint["last_id"])
+        offset = checkpoint["offset"]
+        logger.info(f"Resuming export after {checkpoint['last_id']} at byte {offset}")
+
+    exported = 0
+    with open(path, "r+b" if offset else "wb") as out:
+        # Drop anything written after the last checkpointed batch
+        out.truncate(offset)
+        out.seek(offset)
+        async for member, token in export_batches(collection, projection, after, archive=archive):
+            out.write(member)
+            out.flush()
+            os.fsync(out.fileno())
+            offset = out.tell()
+            exported += 1
+            with open(checkpoint_path, "w") as f:
+                json.dump({"last_id": token, "offset": offset}, f)
+
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return exported
+
+
+async def main(argv) -> int:
+    args = [arg for arg in argv if not arg.startswith("--")]
+    if len(args) != 2 or args[0] not in EXPORTS:
+        print("Usage: python export.py <users|messages> <output.ndjson.gz> [--resume]")
+        return 1
+    name, path = args
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    db = client.chat_app
+    archive = db[ARCHIVES[name]] if name in ARCHIVES else None
+    batches = await export_to_file(db[name], EXPORTS[name], path, resume="--resume" in argv, archive=archive)
+    print(f"Exported {batches} batches of {name} to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -0,0 +1,98 @@
+"""JSON responses straight from raw BSON batches.
+
+List endpoints ask MongoDB to shape each document with a projection (string
+ids, defaults for missing fields), read the results as raw BSON batches,
+decode each batch in one C call and serialize with orjson. This skips the
+per-document dict copy and FastAPI's ``jsonable_encoder`` pass. Projection
+expressions require MongoDB 4.4 or newer.
+"""
+from typing import List, Optional
+
+import bson
+import orjson
+from fastapi.responses import Response
+
+
+def _with_default(field: str, default):
+    return {"$ifNull": [f"${field}", default]}
+
+
+USER_PROJECTION = {
+    "_id": {"$toString": "$_id"},
+    "email": 1,
+    "username": _with_default("username", None),
+    "created_at": _with_default("created_at", None),
+    "last_seen": _with_default("last_seen", None),
+    "is_online": _with_default("is_online", False),
+}
+
+USER_WITH_ROLE_PROJECTION = {
+    **USER_PROJECTION,
+    "role": _with_default("role", "customer"),
+}
+
+MESSAGE_PROJECTION = {
+    "_id": {"$toString": "$_id"},
+    "conversation_id": _with_default("conversation_id", None),
+    "sender_id": 1,
+    "receiver_id": 1,
+    "content": 1,
+    "timestamp": 1,
+    "status": 1,
+    "is_read": 1,
+    "read_at": _with_default("read_at", None),
+    "seq": _with_default("seq", None),
+}
+
+ROOM_PROJECTION = {
+    "_id": 1,
+    "kind": 1,
+    "name": 1,
+    "members": 1,
+    "created_by": 1,
+    "created_at": 1,
+}
+
+ROOM_MESSAGE_PROJECTION = {
+    "_id": {"$toString": "$_id"},
+    "room_id": 1,
+    "seq": 1,
+    "sender_id": 1,
+    "content": 1,
+    "timestamp": 1,
+}
+
+
+INBOX_PROJECTION = {
+    "_id": 1,
+    "conversation_id": 1,
+    "peer_id": 1,
+    "last_message": 1,
+    "last_message_at": 1,
+    "unread_count": 1,
+}
+
+
+async def find_documents(collection, query: dict, projection: dict, sort: Optional[list] = None,
+                         limit: int = 0, batch_size: int = 0, skip: int = 0) -> List[dict]:
+    """Run ``find`` and decode the raw batches; documents come back already shaped."""
+    cursor = collection.find_raw_batches(query, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if skip:
+        cursor = cursor.skip(skip)
+    if limit:
+        cursor = cursor.limit(limit)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    documents = []
+    async for batch in cursor:
+        documents.extend(bson.decode_all(batch))
+    return documents
+
+
+class ORJSONListResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
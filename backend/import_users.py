@@ -0,0 +1,42 @@
+import requests
+import sys
+
+API_URL = "http://localhost:8000"
+
+def import_users(path: str, admin_email: str, admin_password: str):
+    print(f"Logging in as {admin_email}...")
+    response = requests.post(
+        f"{API_URL}/api/auth/login",
+        json={"email": admin_email, "password": admin_password}
+    )
+    if response.status_code != 200:
+        print(f"Login failed: {response.status_code} {response.text}")
+        return False
+    token = response.json()["access_token"]
+
+    content_type = "text/csv" if path.endswith(".csv") else "application/x-ndjson"
+    print(f"Uploading {path} ({content_type})...")
+    with open(path, "rb") as f:
+        # Passing the file object streams the upload instead of reading it into memory
+        response = requests.post(
+            f"{API_URL}/api/admin/users/import",
+            data=f,
+            headers={"Authorization": f"Bearer {token}", "Content-Type": content_type}
+        )
+    if response.status_code != 200:
+        print(f"Import failed: {response.status_code} {response.text}")
+        return False
+
+    report = response.json()
+    print(f"Created: {report['created']}, duplicate: {report['duplicate']}, invalid: {report['invalid']}")
+    for row in report["rows"]:
+        if row["status"] != "created":
+            print(f"   row {row['row']} ({row['email']}): {row['status']} - {row.get('error')}")
+    return True
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print("Usage: python import_users.py <users.ndjson|users.csv> <admin_email> <admin_password>")
+        sys.exit(1)
+
+    import_users(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,251 @@
+"""Index registry for the chat database.
+
+Every index the application relies on is declared here, together with the
+query shapes that depend on them. ``apply`` reconciles the live indexes with
+the registry, ``verify`` explains each query shape and fails on COLLSCAN.
+At startup every worker only creates missing indexes; rebuilding changed ones
+and pruning are left to ``apply`` so workers never drop indexes concurrently.
+
+    python indexes.py apply [--prune]
+    python indexes.py verify
+"""
+import asyncio
+import logging
+import os
+import sys
+from typing import Dict, List
+
+import motor.motor_asyncio
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+logger = logging.getLogger(__name__)
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("role", ASCENDING)]),
+    ],
+    "messages": [
+        IndexModel([("conversation_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("sender_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("receiver_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("timestamp", DESCENDING), ("sender_id", ASCENDING)]),
+        # Catch-up and gap fetches by sequence; messages from before sequences have none
+        IndexModel([("conversation_id", ASCENDING), ("seq", ASCENDING)], unique=True,
+                   partialFilterExpression={"seq": {"$exists": True}}),
+        # Admin full-text search over every message body; MongoDB keeps it current on every insert
+        IndexModel([("content", TEXT)], default_language="english"),
+    ],
+    # Compressed blocks of archived messages; see message_archive.py
+    "messages_cold": [
+        IndexModel([("conversation_id", ASCENDING), ("end_ts", DESCENDING)]),
+        IndexModel([("conversation_id", ASCENDING), ("start_ts", ASCENDING)]),
+        IndexModel([("participants", ASCENDING), ("end_ts", DESCENDING)]),
+        IndexModel([("participants", ASCENDING), ("start_ts", ASCENDING)]),
+        IndexModel([("end_ts", ASCENDING)]),
+    ],
+    # Group rooms and the messages posted to them; see rooms.py
+    "rooms": [
+        IndexModel([("members", ASCENDING), ("created_at", DESCENDING)]),
+    ],
+    "room_messages": [
+        IndexModel([("room_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("room_id", ASCENDING), ("seq", ASCENDING)], unique=True),
+    ],
+    # Admin response-time sketches, one per admin and day; see response_times.py
+    "response_time_sketches": [
+        IndexModel([("day", ASCENDING), ("admin_id", ASCENDING)]),
+    ],
+    # Per-participant search entries; see search.py
+    "search_entries": [
+        IndexModel([("user_id", ASCENDING), ("terms", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("timestamp", ASCENDING)]),
+    ],
+    "conversation_summaries": [
+        IndexModel([("user_id", ASCENDING), ("last_message_at", DESCENDING), ("_id", DESCENDING)]),
+    ],
+    "refresh_tokens": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),
+        IndexModel([("user_id", ASCENDING)]),
+        IndexModel([("family_id", ASCENDING)]),
+    ],
+}
+
+# Representative query shapes; the literal values only need the right types
+QUERY_SHAPES = [
+    {"name": "login_by_email", "collection": "users",
+     "filter": {"email": "someone@example.com"}},
+    {"name": "customers", "collection": "users",
+     "filter": {"role": "customer"}},
+    {"name": "history_by_participant", "collection": "messages",
+     "filter": {"$or": [{"sender_id": "a"}, {"receiver_id": "a"}]},
+     "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "conversation_history", "collection": "messages",
+     "filter": {"conversation_id": "a:b", "timestamp": {"$lte": "2024-01-01T00:00:00"}},
+     "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "sync_after_seq", "collection": "messages",
+     "filter": {"conversation_id": "a:b", "seq": {"$gt": 1}}, "sort": [("seq", ASCENDING)]},
+    {"name": "unread_after_cursor", "collection": "messages",
+     "filter": {"conversation_id": "a:b", "timestamp": {"$gt": "2024-01-01T00:00:00"}, "receiver_id": "b"}},
+    {"name": "compaction_candidates", "collection": "messages",
+     "filter": {"timestamp": {"$lt": "2024-01-01T00:00:00"}, "conversation_id": {"$exists": True}}},
+    {"name": "archive_conversation", "collection": "messages_cold",
+     "filter": {"conversation_id": "a:b", "start_ts": {"$lte": "2024-01-01T00:00:00"}},
+     "sort": [("end_ts", DESCENDING)]},
+    {"name": "archive_participant", "collection": "messages_cold",
+     "filter": {"participants": "a", "start_ts": {"$lte": "2024-01-01T00:00:00"}},
+     "sort": [("end_ts", DESCENDING)]},
+    {"name": "archive_retention", "collection": "messages_cold",
+     "filter": {"end_ts": {"$lt": "2024-01-01T00:00:00"}}},
+    {"name": "rooms_of_member", "collection": "rooms",
+     "filter": {"members": "a"}, "sort": [("created_at", DESCENDING)]},
+    {"name": "room_history", "collection": "room_messages",
+     "filter": {"room_id": "r", "timestamp": {"$lte": "2024-01-01T00:00:00"}},
+     "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "response_time_range", "collection": "response_time_sketches",
+     "filter": {"day": {"$gte": "2024-01-01", "$lte": "2024-01-07"}}},
+    {"name": "inbox", "collection": "conversation_summaries",
+     "filter": {"user_id": "a"}, "sort": [("last_message_at", DESCENDING), ("_id", DESCENDING)]},
+    {"name": "search", "collection": "search_entries",
+     "filter": {"user_id": "a", "terms": {"$all": ["hello", "world"]}},
+     "sort": [("timestamp", DESCENDING), ("_id", DESCENDING)], "limit": 21},
+    {"name": "search_all", "collection": "messages",
+     "filter": {"$text": {"$search": "hello"}}},
+    {"name": "search_retention", "collection": "search_entries",
+     "filter": {"timestamp": {"$lt": "2024-01-01T00:00:00"}}},
+    {"name": "stats_since", "collection": "messages",
+     "filter": {"timestamp": {"$gte": "2024-01-01T00:00:00"}}},
+    {"name": "refresh_tokens_by_family", "collection": "refresh_tokens",
+     "filter": {"family_id": "f"}},
+]
+
+
+# Options that change what an index does; anything else is informational
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression", "default_language")
+
+
+def _index_signature(spec: dict) -> tuple:
+    key = dict(spec["key"])
+    if "_fts" in key:
+        # The server reports text indexes as _fts/_ftsx plus a weights document
+        del key["_fts"]
+        key.pop("_ftsx", None)
+        key.update({field: TEXT for field in spec.get("weights", {})})
+    keys = tuple((field, int(direction)) for field, direction in key.items() if direction != TEXT)
+    text_fields = tuple(sorted(field for field, direction in key.items() if direction == TEXT))
+    options = tuple((option, spec[option]) for option in INDEX_OPTIONS if option in spec)
+    return keys, text_fields, options
+
+
+async def ensure_indexes(db) -> dict:
+    """Create missing indexes only; report changed ones and collections that failed."""
+    report = {"created": [], "outdated": [], "failed": []}
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        try:
+            existing = {info["name"]: info async for info in collection.list_indexes()}
+            missing = [model for model in models if model.document["name"] not in existing]
+            report["outdated"].extend(
+                f"{collection_name}.{model.document['name']}" for model in models
+                if model.document["name"] in existing
+                and _index_signature(existing[model.document["name"]]) != _index_signature(model.document)
+            )
+            if missing:
+                await collection.create_indexes(missing)
+                report["created"].extend(f"{collection_name}.{model.document['name']}" for model in missing)
+        except Exception as e:
+            logger.error(f"Failed to create indexes on {collection_name}: {e}")
+            report["failed"].append(collection_name)
+    return report
+
+
+async def apply_indexes(db, prune: bool = False) -> dict:
+    """Create missing indexes, rebuild changed ones and optionally drop unmanaged ones."""
+    report = {"created": [], "rebuilt": [], "dropped": [], "unchanged": []}
+    for collection_name, models in INDEXES.items():
+        collection = db[collection_name]
+        existing = {info["name"]: info async for info in collection.list_indexes()}
+        to_create = []
+        for model in models:
+            name = model.document["name"]
+            current = existing.get(name)
+            if current is None:
+                to_create.append(model)
+                report["created"].append(f"{collection_name}.{name}")
+            elif _index_signature(current) != _index_signature(model.document):
+                await collection.drop_index(name)
+                to_create.append(model)
+                report["rebuilt"].append(f"{collection_name}.{name}")
+            else:
+                report["unchanged"].append(f"{collection_name}.{name}")
+        if to_create:
+            await collection.create_indexes(to_create)
+
+        if prune:
+            managed = {model.document["name"] for model in models} | {"_id_"}
+            for name in existing:
+                if name not in managed:
+                    await collection.drop_index(name)
+                    report["dropped"].append(f"{collection_name}.{name}")
+    return report
+
+
+def _plan_stages(plan) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+async def verify_query_plans(db) -> List[dict]:
+    """Explain every registered query shape and report which ones scan the collection."""
+    results = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape["collection"]].find(shape["filter"])
+        if shape.get("sort"):
+            cursor = cursor.sort(shape["sort"])
+        if shape.get("limit"):
+            cursor = cursor.limit(shape["limit"])
+        explain = await cursor.explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        results.append({
+            "name": shape["name"],
+            "collection": shape["collection"],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+        })
+    return results
+
+
+async def main(argv: List[str]) -> int:
+    if not argv or argv[0] not in ("apply", "verify"):
+        print("Usage: python indexes.py apply [--prune] | verify")
+        return 1
+
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    db = client.chat_app
+
+    if argv[0] == "apply":
+        report = await apply_indexes(db, prune="--prune" in argv)
+        for action in ("created", "rebuilt", "dropped", "unchanged"):
+            for name in report[action]:
+                print(f"{action:>9}  {name}")
+        return 0
+
+    failed = False
+    for result in await verify_query_plans(db):
+        status = "COLLSCAN" if result["collscan"] else "ok"
+        failed = failed or result["collscan"]
+        print(f"{status:>8}  {result['collection']}.{result['name']}: {' > '.join(result['stages'])}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -1,18 +1,48 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Body, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, status, Body, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional
 from datetime import datetime, timedelta
 import motor.motor_asyncio
-from bson import ObjectId
-import bcrypt
 from jose import jwt, JWTError
 import logging
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 import os
 from dotenv import load_dotenv
 import json
+from password_hasher import password_hasher, PasswordHasherBusy
+from principal_cache import PrincipalCache
+from refresh_tokens import RefreshTokenStore
+from user_import import UserImporter, parse_csv, parse_ndjson
+from indexes import ensure_indexes, verify_query_plans
+from conversations import conversation_id_for
+from export import ARCHIVES, EXPORTS, export_stream, parse_resume_token
+from fast_json import (
+    MESSAGE_PROJECTION, USER_PROJECTION, USER_WITH_ROLE_PROJECTION, INBOX_PROJECTION, ROOM_PROJECTION,
+    ROOM_MESSAGE_PROJECTION, ORJSONListResponse, find_documents
+)
+from message_writer import GroupCommitWriter
+from read_cursors import ReadCursorStore
+from conversation_summaries import ConversationSummaries
+from message_archive import MessageArchive
+from message_router import InMemoryRouter, RedisRouter
+from outbound import CAPACITY_CLOSE_CODE, OutboundRegistry
+from rooms import ANNOUNCEMENTS, Rooms
+from ephemeral import EPHEMERAL_TYPES, EphemeralLane
+from stats import InMemoryStatsStore, RedisStatsStore, StatsEngine
+from response_times import ResponseTimeTracker
+from presence import PRESENCE_MAX_QUERY, InMemoryPresenceStore, PresenceTracker, RedisPresenceStore
+from ws_protocol import ProtocolError, negotiate
+from sync import SequenceAllocator, fetch_range, missed_messages, participant_of
+from search import SearchIndex, decode_offset, encode_offset, search_messages
+from pagination import DEFAULT_PAGE_SIZE, decode_cursor, encode_cursor, keyset_filter, page_params, sort_spec
+from redis_client import get_redis, close_redis
+from rate_limit import (
+    ConcurrencyGate, InMemoryBucketStore, RateLimited, RedisBucketStore, TokenBucketLimiter,
+    LOGIN_BURST_PER_EMAIL, LOGIN_BURST_PER_IP, LOGIN_MAX_CONCURRENT, LOGIN_RATE_PER_EMAIL,
+    LOGIN_RATE_PER_IP, check_all, client_ip, retry_after_header
+)
 
 # Load environment variables
 load_dotenv()
@@ -34,6 +64,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # MongoDB connection
@@ -43,19 +74,87 @@ try:
     db = client.chat_app
     users_collection = db.users
     messages_collection = db.messages
+    messages_cold_collection = db.messages_cold
+    refresh_tokens_collection = db.refresh_tokens
+    read_cursors_collection = db.read_cursors
+    conversation_summaries_collection = db.conversation_summaries
+    search_entries_collection = db.search_entries
+    conversation_sequences_collection = db.conversation_sequences
+    response_time_state_collection = db.response_time_state
+    response_time_sketches_collection = db.response_time_sketches
+    rooms_collection = db.rooms
+    room_messages_collection = db.room_messages
     logger.info("Successfully connected to MongoDB")
 except Exception as e:
     logger.error(f"Failed to connect to MongoDB: {e}")
     raise
 
-# WebSocket active connections
-active_connections: Dict[str, WebSocket] = {}
+# Authenticated user cache
+principal_cache = PrincipalCache(users_collection)
+
+# Server-side refresh tokens
+refresh_token_store = RefreshTokenStore(refresh_tokens_collection)
+
+# Login admission control
+rate_limit_store = RedisBucketStore(get_redis()) if get_redis() is not None else InMemoryBucketStore()
+login_ip_limiter = TokenBucketLimiter("login-ip", LOGIN_BURST_PER_IP, LOGIN_RATE_PER_IP, rate_limit_store)
+login_email_limiter = TokenBucketLimiter("login-email", LOGIN_BURST_PER_EMAIL, LOGIN_RATE_PER_EMAIL, rate_limit_store)
+login_gate = ConcurrencyGate(LOGIN_MAX_CONCURRENT)
+
+# Per-conversation message sequence numbers
+sequences = SequenceAllocator(conversation_sequences_collection)
+
+# Group-commit writer for chat messages
+message_writer = GroupCommitWriter(messages_collection)
+
+# Per-conversation read cursors
+read_cursors = ReadCursorStore(read_cursors_collection)
+
+# Inbox summaries, kept current from persisted messages and read cursors
+conversation_summaries = ConversationSummaries(conversation_summaries_collection, messages_collection, read_cursors)
+message_writer.add_listener(conversation_summaries.on_messages)
+read_cursors.add_listener(conversation_summaries.on_read)
+
+# Per-participant search entries covering every conversation of a user
+search_index = SearchIndex(search_entries_collection)
+message_writer.add_listener(search_index.on_messages)
+
+# Per-conversation admin response times, kept as quantile sketches per admin and day
+response_times = ResponseTimeTracker(response_time_state_collection, response_time_sketches_collection, users_collection)
+message_writer.add_listener(response_times.on_messages)
+
+# Admin dashboard counters, updated per persisted batch and reconciled periodically
+stats_store = RedisStatsStore(get_redis()) if get_redis() is not None else InMemoryStatsStore()
+stats = StatsEngine(users_collection, messages_collection, messages_cold_collection, stats_store, response_times)
+message_writer.add_listener(stats.on_messages)
+
+# Compressed cold tier for old messages; compaction runs from message_archive.py
+message_archive = MessageArchive(messages_collection, messages_cold_collection)
+
+# WebSocket delivery to users connected to any worker
+message_router = RedisRouter(get_redis()) if get_redis() is not None else InMemoryRouter()
+
+# Group rooms and admin announcements, stored once and fanned out to members
+rooms = Rooms(rooms_collection, room_messages_collection, users_collection, sequences, message_router)
+
+# Typing indicators and presence pings; rate-coalesced and never stored
+ephemeral = EphemeralLane(message_router)
+
+# Bounded per-socket send queues, drained by one writer task per connection
+outbound = OutboundRegistry()
+
+# Online presence and batched last_seen writes
+presence_store = RedisPresenceStore(get_redis()) if get_redis() is not None else InMemoryPresenceStore()
+presence = PresenceTracker(users_collection, presence_store)
 
 # JWT settings
 SECRET_KEY = "your-secret-key"  # In production, use environment variable
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Explain the registered query shapes at startup and refuse to start on COLLSCAN
+VERIFY_QUERY_PLANS = os.getenv("VERIFY_QUERY_PLANS", "false").lower() == "true"
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Models
@@ -96,29 +195,145 @@ class AdminStats(BaseModel):
     average_response_time: float
 
 # Helper functions
+def hasher_busy_error():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please retry shortly",
+        headers={"Retry-After": "1"}
+    )
+
+async def hash_password(password: str) -> bytes:
+    try:
+        return await password_hasher.hash_password(password)
+    except PasswordHasherBusy:
+        raise hasher_busy_error()
+
+async def verify_password(password: str, hashed_pw) -> bool:
+    try:
+        return await password_hasher.verify_password(password, hashed_pw)
+    except PasswordHasherBusy:
+        raise hasher_busy_error()
+
+def rate_limited_error(retry_after: float):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many login attempts, please retry later",
+        headers={"Retry-After": retry_after_header(retry_after)}
+    )
+
+async def admit_login(request: Request, email: Optional[str]):
+    try:
+        # Neither bucket is charged when the other one rejects
+        await check_all([(login_ip_limiter, client_ip(request)),
+                         (login_email_limiter, (email or "").strip().lower())])
+    except RateLimited as e:
+        raise rate_limited_error(e.retry_after)
+
+async def verify_login_password(password: str, hashed_pw) -> bool:
+    try:
+        async with login_gate.slot():
+            return await verify_password(password, hashed_pw)
+    except RateLimited as e:
+        raise rate_limited_error(e.retry_after)
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        expire = datetime.utcnow() + timedelta(minutes=15)
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+async def issue_tokens(user_id: str) -> dict:
+    return {
+        "access_token": create_access_token(data={"sub": user_id}),
+        "refresh_token": await refresh_token_store.issue(user_id),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = await users_collection.find_one({"_id": ObjectId(user_id)})
+        user = await principal_cache.get(user_id)
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
         return user
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def websocket_token_subject(websocket: WebSocket) -> Optional[str]:
+    """The user id of the access token offered in the ``token`` query parameter or an Authorization header."""
+    token = websocket.query_params.get("token")
+    authorization = websocket.headers.get("authorization", "")
+    if token is None and authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if token is None:
+        return None
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+
+# Lifecycle
+@app.on_event("startup")
+async def startup():
+    password_hasher.start()
+    await message_writer.start()
+    await read_cursors.start()
+    await message_router.start()
+    await presence.start()
+    await outbound.start()
+    await stats.start()
+    report = await ensure_indexes(db)
+    if report["created"]:
+        logger.info(f"Indexes created: {report['created']}")
+    if report["outdated"]:
+        logger.warning(f"Indexes differ from the registry, run python indexes.py apply: {report['outdated']}")
+    if VERIFY_QUERY_PLANS:
+        collscans = [result["name"] for result in await verify_query_plans(db) if result["collscan"]]
+        if collscans:
+            raise RuntimeError(f"Query shapes using COLLSCAN: {', '.join(collscans)}")
+
+@app.on_event("shutdown")
+async def shutdown():
+    await message_writer.stop()
+    await stats.stop()
+    await read_cursors.stop()
+    await outbound.stop()
+    await ephemeral.stop()
+    await message_router.stop()
+    await presence.stop()
+    password_hasher.shutdown()
+    await close_redis()
+
+async def fetch_hot_messages(query: dict, cursor: Optional[str], limit: int, order: str) -> List[dict]:
+    return await find_documents(
+        messages_collection, {**query, **keyset_filter(cursor, order)}, MESSAGE_PROJECTION,
+        sort=sort_spec(order), limit=limit, batch_size=limit
+    )
+
+async def fetch_message_page(query: dict, archive_scope: dict, cursor: Optional[str], limit: int, order: str) -> Response:
+    # Fetch one extra document to learn whether another page exists
+    wanted = limit + 1
+    # Compaction skips messages without a conversation_id, so old ones can stay
+    # hot: the tiers overlap in time and are merged. A full hot page bounds the
+    # archive read, so recent pages skip the archive entirely
+    messages = await fetch_hot_messages(query, cursor, wanted, order)
+    bound = messages[-1]["timestamp"] if len(messages) == wanted else None
+    messages += await message_archive.read_page(archive_scope, decode_cursor(cursor) if cursor else None,
+                                                order, wanted, bound=bound)
+    messages.sort(key=lambda message: (message["timestamp"], message["_id"]), reverse=order == "desc")
+    del messages[wanted:]
+    headers = {}
+    if len(messages) > limit:
+        messages = messages[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(messages[-1]["timestamp"], messages[-1]["_id"])
+    await read_cursors.apply_read_state(messages)
+    return ORJSONListResponse(messages, headers=headers)
+
 # Routes
 @app.get("/")
 async def root():
@@ -132,9 +347,10 @@ async def root():
     )
 
 @app.post("/api/login")
-async def login(form_data: OAuth2PasswordRequestForm = Depends()):
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
     try:
         logger.info(f"Login attempt for email: {form_data.username}")
+        await admit_login(request, form_data.username)
 
         # Find user
         user = await users_collection.find_one({"email": form_data.username})
@@ -146,35 +362,23 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
             )
 
         # Verify password
-        hashed_pw = user["password"]
-        if isinstance(hashed_pw, str):
-            hashed_pw = hashed_pw.encode()
-        if not bcrypt.checkpw(form_data.password.encode(), hashed_pw):
+        if not await verify_login_password(form_data.password, user["password"]):
             logger.warning(f"Login failed: Invalid password for email {form_data.username}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid email or password"
             )
 
-        # Create token
-        access_token = create_access_token(data={"sub": str(user["_id"])})
+        # Create tokens
+        tokens = await issue_tokens(str(user["_id"]))
 
-        # Update last seen
-        await users_collection.update_one(
-            {"_id": user["_id"]},
-            {
-                "$set": {
-                    "last_seen": datetime.now().isoformat(),
-                    "is_online": True
-                }
-            }
-        )
+        # Update last seen; written to Mongo with the next presence flush
+        await presence.heartbeat(user["_id"])
 
         logger.info(f"Login successful for email: {form_data.username}")
 
         return {
-            "access_token": access_token,
-            "token_type": "bearer",
+            **tokens,
             "user": {
                 "id": str(user["_id"]),
                 "email": user["email"],
@@ -183,7 +387,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
                 "isFirstLogin": user.get("isFirstLogin", True),
                 "created_at": user.get("created_at"),
                 "last_seen": user.get("last_seen"),
-                "is_online": user.get("is_online", False)
+                "is_online": True
             }
         }
     except HTTPException:
@@ -204,10 +408,11 @@ async def create_customer(user: User, current_user: dict = Depends(get_current_u
         if await users_collection.find_one({"email": user.email}):
             raise HTTPException(status_code=400, detail="Email already registered")
 
-        hashed_password = bcrypt.hashpw(user.password.encode(), bcrypt.gensalt())
+        hashed_password = await hash_password(user.password)
         user_dict = user.dict()
         user_dict["password"] = hashed_password
         result = await users_collection.insert_one(user_dict)
+        await stats.on_users_created(user.role)
 
         return {
             "_id": str(result.inserted_id),
@@ -217,70 +422,142 @@ async def create_customer(user: User, current_user: dict = Depends(get_current_u
             "isFirstLogin": user.isFirstLogin,
             "created_at": user.created_at
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Create customer error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/api/admin/users/import")
+async def import_users(request: Request, format: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+    content_type = request.headers.get("content-type", "")
+    if format is None:
+        format = "csv" if "csv" in content_type else "ndjson"
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+
+    try:
+        parser = parse_csv if format == "csv" else parse_ndjson
+        importer = UserImporter(users_collection, password_hasher, User)
+        report = await importer.run(parser(request.stream()))
+        if report["created"]:
+            # Imported roles vary per row; recount instead of guessing
+            await stats.reconcile()
+        logger.info(f"User import by {current_user['email']}: {report['created']} created, "
+                    f"{report['duplicate']} duplicate, {report['invalid']} invalid")
+        return report
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Upload must be UTF-8 encoded")
+    except Exception as e:
+        logger.error(f"Import users error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.get("/api/admin/export/{collection}")
+async def export_collection(collection: str, after: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if collection not in EXPORTS:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    try:
+        after_id = parse_resume_token(after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # To resume, pass the _id of the last line received as ?after=, or
+    # archive:<_archive_block> once the lines come from the cold archive
+    archive = db[ARCHIVES[collection]] if collection in ARCHIVES else None
+    logger.info(f"Export of {collection} after {after} started by {current_user['email']}")
+    return StreamingResponse(
+        export_stream(db[collection], EXPORTS[collection], after_id, archive),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{collection}.ndjson.gz"'}
+    )
+
 @app.get("/api/admin/users")
 async def get_users(current_user: dict = Depends(get_current_user)):
     try:
         if current_user.get("role") != "admin":
             raise HTTPException(status_code=403, detail="Admin access required")
 
-        users = []
-        async for user in users_collection.find({"role": "customer"}):
-            users.append({
-                "_id": str(user["_id"]),
-                "email": user["email"],
-                "username": user.get("username"),
-                "created_at": user.get("created_at"),
-                "last_seen": user.get("last_seen"),
-                "is_online": user.get("is_online", False)
-            })
-        return users
+        users = await find_documents(users_collection, {"role": "customer"}, USER_PROJECTION)
+        return ORJSONListResponse(await presence.apply_presence(users))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Get users error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.get("/api/admin/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return {
+        "password_hasher": password_hasher.metrics(),
+        "principal_cache": principal_cache.metrics(),
+        "message_writer": message_writer.metrics(),
+        "sequences": sequences.metrics(),
+        "read_cursors": read_cursors.metrics(),
+        "message_router": message_router.metrics(),
+        "rooms": rooms.metrics(),
+        "ephemeral": ephemeral.metrics(),
+        "presence": presence.metrics(),
+        "stats": stats.metrics(),
+        "response_times": response_times.metrics(),
+        "outbound": outbound.metrics(),
+        "login_admission": {
+            "per_ip": login_ip_limiter.metrics(),
+            "per_email": login_email_limiter.metrics(),
+            "verify_gate": login_gate.metrics()
+        }
+    }
+
 @app.get("/api/admin/stats")
 async def get_admin_stats(current_user: dict = Depends(get_current_user)):
     try:
         if current_user.get("role") != "admin":
             raise HTTPException(status_code=403, detail="Admin access required")
 
-        total_users = await users_collection.count_documents({"role": "customer"})
-        total_messages = await messages_collection.count_documents({})
-
-        yesterday = datetime.now() - timedelta(days=1)
-        active_users = len(await messages_collection.distinct("sender_id", {"timestamp": {"$gte": yesterday.isoformat()}}))
-
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        messages_today = await messages_collection.count_documents({"timestamp": {"$gte": today.isoformat()}})
-
-        messages = await messages_collection.find().sort("timestamp", -1).limit(1000).to_list(length=1000)
-        response_times = []
-        for i in range(1, len(messages)):
-            if messages[i-1]["sender_id"] != messages[i]["sender_id"]:
-                time_diff = datetime.fromisoformat(messages[i-1]["timestamp"]) - datetime.fromisoformat(messages[i]["timestamp"])
-                response_times.append(time_diff.total_seconds())
-
-        avg_response_time = sum(response_times) / len(response_times) if response_times else 0
-
+        # Counters kept by the stats engine; see stats.py
+        snapshot = await stats.snapshot()
         return AdminStats(
-            total_users=total_users,
-            total_messages=total_messages,
-            active_users=active_users,
-            messages_today=messages_today,
-            average_response_time=avg_response_time
+            total_users=snapshot["total_users"],
+            total_messages=snapshot["total_messages"],
+            active_users=snapshot["active_users"],
+            messages_today=snapshot["messages_today"],
+            average_response_time=snapshot["average_response_time"]
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Get stats error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.get("/api/admin/analytics/response-times")
+async def get_response_times(
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    admin_id: Optional[List[str]] = Query(None),
+    current_user: dict = Depends(get_current_user)
+):
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    today = datetime.now().date()
+    try:
+        return await response_times.query(start or (today - timedelta(days=6)).isoformat(),
+                                          end or today.isoformat(), admin_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Response time analytics error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @app.post("/api/users/change-password")
 async def change_password(new_password: str, current_user: dict = Depends(get_current_user)):
     try:
-        hashed_password = bcrypt.hashpw(new_password.encode(), bcrypt.gensalt())
+        hashed_password = await hash_password(new_password)
         await users_collection.update_one(
             {"_id": current_user["_id"]},
             {
@@ -290,65 +567,247 @@ async def change_password(new_password: str, current_user: dict = Depends(get_cu
                 }
             }
         )
+        await principal_cache.invalidate(current_user["_id"])
         return {"status": "success"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Change password error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/api/messages/{user_id}")
-async def get_messages(user_id: str, current_user: dict = Depends(get_current_user)):
+async def get_messages(
+    user_id: str,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    order: str = "desc",
+    current_user: dict = Depends(get_current_user)
+):
     try:
-        messages = []
-        async for message in messages_collection.find({
+        limit = page_params(limit, order)
+        query = {
             "$or": [
                 {"sender_id": user_id},
                 {"receiver_id": user_id}
             ]
-        }):
-            messages.append({
-                "_id": str(message["_id"]),
-                "sender_id": message["sender_id"],
-                "receiver_id": message["receiver_id"],
-                "content": message["content"],
-                "timestamp": message["timestamp"],
-                "status": message["status"],
-                "is_read": message["is_read"],
-                "read_at": message.get("read_at")
-            })
-        return messages
+        }
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        return await fetch_message_page(query, {"participants": user_id}, cursor, limit, order)
     except Exception as e:
         logger.error(f"Get messages error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.get("/api/conversations/{peer_id}/messages")
+async def get_conversation_messages(
+    peer_id: str,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    order: str = "desc",
+    current_user: dict = Depends(get_current_user)
+):
+    try:
+        limit = page_params(limit, order)
+        query = {"conversation_id": conversation_id_for(current_user["_id"], peer_id)}
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        return await fetch_message_page(query, query, cursor, limit, order)
+    except Exception as e:
+        logger.error(f"Get conversation messages error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.get("/api/search/messages")
+async def search_messages_endpoint(
+    q: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    user_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    # Admins search everything or one user's conversations; everyone else only their own
+    if current_user.get("role") == "admin":
+        participant_id = user_id
+    elif user_id is None or user_id == str(current_user["_id"]):
+        participant_id = str(current_user["_id"])
+    else:
+        raise HTTPException(status_code=403, detail="Not authorized")
+    try:
+        limit = page_params(limit, "desc")
+        offset = decode_offset(cursor)
+        results, next_offset = await search_messages(messages_collection, search_index,
+                                                     q, participant_id, limit, offset)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Search messages error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+    await read_cursors.apply_read_state(results)
+    headers = {"X-Next-Cursor": encode_offset(next_offset)} if next_offset is not None else {}
+    return ORJSONListResponse(results, headers=headers)
+
+@app.get("/api/inbox")
+async def get_inbox(
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    try:
+        limit = page_params(limit, "desc")
+        query = {
+            "user_id": str(current_user["_id"]),
+            **keyset_filter(cursor, "desc", field="last_message_at", object_id=False)
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        conversations = await find_documents(
+            conversation_summaries_collection, query, INBOX_PROJECTION,
+            sort=sort_spec("desc", field="last_message_at"), limit=limit + 1, batch_size=limit + 1
+        )
+        headers = {}
+        if len(conversations) > limit:
+            conversations = conversations[:limit]
+            last = conversations[-1]
+            headers["X-Next-Cursor"] = encode_cursor(last["last_message_at"], last["_id"])
+        return ORJSONListResponse(conversations, headers=headers)
+    except Exception as e:
+        logger.error(f"Get inbox error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @app.post("/api/messages/send")
 async def send_message(message: Message, current_user: dict = Depends(get_current_user)):
     try:
         message_dict = message.dict()
-        result = await messages_collection.insert_one(message_dict)
-        message_dict["_id"] = str(result.inserted_id)
-        return message_dict
+        message_dict["conversation_id"] = conversation_id_for(message.sender_id, message.receiver_id)
+        message_dict["seq"] = await sequences.next(message_dict["conversation_id"])
+        await message_writer.write(message_dict, wait=True)
+        return {**message_dict, "_id": str(message_dict["_id"])}
     except Exception as e:
         logger.error(f"Send message error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/api/admin/broadcast")
+async def broadcast(data: dict = Body(...), current_user: dict = Depends(get_current_user)):
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    message = data.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise HTTPException(status_code=400, detail="message is required")
+    try:
+        stored, delivered = await rooms.post(ANNOUNCEMENTS, str(current_user["_id"]), message)
+        logger.info(f"Broadcast by {current_user['email']} reached {delivered} sockets on this worker")
+        return {**stored, "delivered": delivered}
+    except Exception as e:
+        logger.error(f"Broadcast error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.post("/api/rooms")
+async def create_room(data: dict = Body(...), current_user: dict = Depends(get_current_user)):
+    try:
+        return await rooms.create(data.get("name"), str(current_user["_id"]), data.get("member_ids", []))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Create room error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.get("/api/rooms")
+async def get_rooms(current_user: dict = Depends(get_current_user)):
+    try:
+        groups = await find_documents(rooms_collection, {"members": str(current_user["_id"])}, ROOM_PROJECTION,
+                                      sort=[("created_at", -1)])
+        return ORJSONListResponse([ANNOUNCEMENTS, *groups])
+    except Exception as e:
+        logger.error(f"Get rooms error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+async def room_for(room_id: str, current_user: dict, post: bool = False) -> dict:
+    room = await rooms.get(room_id)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    allowed = rooms.can_post if post else rooms.can_read
+    if not allowed(room, str(current_user["_id"]), current_user.get("role") == "admin"):
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    return room
+
+@app.post("/api/rooms/{room_id}/members")
+async def update_room_members(room_id: str, data: dict = Body(...), current_user: dict = Depends(get_current_user)):
+    room = await room_for(room_id, current_user)
+    if room["kind"] != "group" or (room["created_by"] != str(current_user["_id"]) and current_user.get("role") != "admin"):
+        raise HTTPException(status_code=403, detail="Only the room's creator or an admin can change its members")
+    try:
+        return await rooms.update_members(room, data.get("add", []), data.get("remove", []))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Update room members error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.post("/api/rooms/{room_id}/messages")
+async def post_room_message(room_id: str, data: dict = Body(...), current_user: dict = Depends(get_current_user)):
+    room = await room_for(room_id, current_user, post=True)
+    message = data.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise HTTPException(status_code=400, detail="message is required")
+    try:
+        stored, delivered = await rooms.post(room, str(current_user["_id"]), message)
+        return {**stored, "delivered": delivered}
+    except Exception as e:
+        logger.error(f"Post room message error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.get("/api/rooms/{room_id}/messages")
+async def get_room_messages(
+    room_id: str,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    order: str = "desc",
+    current_user: dict = Depends(get_current_user)
+):
+    await room_for(room_id, current_user)
+    try:
+        limit = page_params(limit, order)
+        query = {"room_id": room_id, **keyset_filter(cursor, order)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        messages = await find_documents(room_messages_collection, query, ROOM_MESSAGE_PROJECTION,
+                                        sort=sort_spec(order), limit=limit + 1, batch_size=limit + 1)
+        headers = {}
+        if len(messages) > limit:
+            messages = messages[:limit]
+            headers["X-Next-Cursor"] = encode_cursor(messages[-1]["timestamp"], messages[-1]["_id"])
+        return ORJSONListResponse(messages, headers=headers)
+    except Exception as e:
+        logger.error(f"Get room messages error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @app.post("/api/messages/read")
-async def mark_messages_as_read(sender_id: str, receiver_id: str, current_user: dict = Depends(get_current_user)):
+async def mark_messages_as_read(
+    sender_id: str,
+    receiver_id: str,
+    up_to: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    if receiver_id != str(current_user["_id"]):
+        raise HTTPException(status_code=403, detail="Only the receiver can mark a conversation read")
     try:
-        await messages_collection.update_many(
-            {
-                "sender_id": sender_id,
-                "receiver_id": receiver_id,
-                "is_read": False
-            },
-            {
-                "$set": {
-                    "is_read": True,
-                    "read_at": datetime.now().isoformat(),
-                    "status": "read"
-                }
-            }
-        )
+        # Moves the receiver's cursor for the conversation; messages are not rewritten
+        read_cursors.mark_read(receiver_id, conversation_id_for(sender_id, receiver_id), up_to)
         return {"status": "success"}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Mark messages as read error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -356,6 +815,8 @@ async def mark_messages_as_read(sender_id: str, receiver_id: str, current_user:
 @app.get("/api/users/me")
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     try:
+        user_id = str(current_user["_id"])
+        user_presence = await presence.lookup([user_id], {user_id: current_user.get("last_seen")})
         return {
             "_id": str(current_user["_id"]),
             "email": current_user["email"],
@@ -363,8 +824,7 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
             "role": current_user.get("role", "customer"),
             "isFirstLogin": current_user.get("isFirstLogin", True),
             "created_at": current_user.get("created_at"),
-            "last_seen": current_user.get("last_seen"),
-            "is_online": current_user.get("is_online", False)
+            **user_presence[user_id]
         }
     except Exception as e:
         logger.error(f"Get current user info error: {e}")
@@ -374,44 +834,34 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 async def create_user(user: User = Body(...)):
     if await users_collection.find_one({"email": user.email}):
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = bcrypt.hashpw(user.password.encode(), bcrypt.gensalt())
+    hashed_password = await hash_password(user.password)
     user_dict = user.dict()
     user_dict["password"] = hashed_password
     result = await users_collection.insert_one(user_dict)
+    await stats.on_users_created(user.role)
     return {"_id": str(result.inserted_id), "email": user.email}
 
 @app.post("/api/auth/login")
-async def login(data: dict = Body(...)):
+async def login(request: Request, data: dict = Body(...)):
     email = data.get("email")
     password = data.get("password")
+    await admit_login(request, email)
     user = await users_collection.find_one({"email": email})
     if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
 
     # Fix password checking
-    hashed_pw = user["password"]
-    if isinstance(hashed_pw, str):
-        hashed_pw = hashed_pw.encode()
-    if not bcrypt.checkpw(password.encode(), hashed_pw):
+    if not await verify_login_password(password, user["password"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
 
-    # Generate and return a token here if you use JWT, or just return user info
-    access_token = create_access_token(data={"sub": str(user["_id"])})
+    # Generate access and refresh tokens
+    tokens = await issue_tokens(str(user["_id"]))
 
-    # Update last seen
-    await users_collection.update_one(
-        {"_id": user["_id"]},
-        {
-            "$set": {
-                "last_seen": datetime.now().isoformat(),
-                "is_online": True
-            }
-        }
-    )
+    # Update last seen; written to Mongo with the next presence flush
+    await presence.heartbeat(user["_id"])
 
     return {
-        "access_token": access_token,
-        "token_type": "bearer",
+        **tokens,
         "user": {
             "id": str(user["_id"]),
             "email": user["email"],
@@ -420,62 +870,172 @@ async def login(data: dict = Body(...)):
             "isFirstLogin": user.get("isFirstLogin", True),
             "created_at": user.get("created_at"),
             "last_seen": user.get("last_seen"),
-            "is_online": user.get("is_online", False)
+            "is_online": True
         }
     }
 
+@app.post("/api/auth/refresh")
+async def refresh_access_token(data: dict = Body(...)):
+    refresh_token = data.get("refresh_token")
+    if not refresh_token:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+    rotated = await refresh_token_store.rotate(refresh_token)
+    if rotated is None:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+
+    user_id, new_refresh_token = rotated
+    return {
+        "access_token": create_access_token(data={"sub": user_id}),
+        "refresh_token": new_refresh_token,
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+@app.post("/api/auth/logout")
+async def logout(data: dict = Body(...)):
+    refresh_token = data.get("refresh_token")
+    if refresh_token:
+        await refresh_token_store.revoke(refresh_token)
+    return {"status": "success"}
+
+async def resume_session(connection, user_id: str, data: dict):
+    """Stream what the client missed, holding live delivery until it has caught up."""
+    cursors = data.get("cursors") or {}
+    since = data.get("since")
+    if not isinstance(cursors, dict) or not all(isinstance(seq, int) for seq in cursors.values()) \
+            or (since is not None and not isinstance(since, str)):
+        await connection.send_now({"type": "error", "detail": "resume needs cursors {conversation_id: seq} and an optional since"})
+        return
+    synced = dict(cursors)
+    connection.hold()
+    try:
+        async for frame in missed_messages(messages_collection, conversation_summaries_collection,
+                                           user_id, cursors, since):
+            await read_cursors.apply_read_state(frame["messages"])
+            for message in frame["messages"]:
+                if message["seq"] is not None:
+                    synced[message["conversation_id"]] = max(synced.get(message["conversation_id"], 0), message["seq"])
+            await connection.send_now(frame)
+        await connection.send_now({"type": "sync_done", "cursors": synced})
+    finally:
+        connection.release(synced)
+
+async def fetch_missing(connection, user_id: str, data: dict):
+    conversation_id = data.get("conversation_id")
+    from_seq, to_seq = data.get("from_seq"), data.get("to_seq")
+    if not isinstance(conversation_id, str) or not participant_of(conversation_id, user_id) \
+            or not isinstance(from_seq, int) or not isinstance(to_seq, int):
+        await connection.send_now({"type": "error", "detail": "fetch needs one of your conversation_ids, from_seq and to_seq"})
+        return
+    try:
+        messages = await fetch_range(messages_collection, conversation_id, from_seq, to_seq)
+    except ValueError as e:
+        await connection.send_now({"type": "error", "detail": str(e)})
+        return
+    await read_cursors.apply_read_state(messages)
+    await connection.send_now({"type": "fetch", "conversation_id": conversation_id,
+                               "from_seq": from_seq, "to_seq": to_seq, "messages": messages})
+
+async def handle_frame(connection, user_id: str, data: dict):
+    recipient_id = data.get("recipient_id")
+    message = data.get("message")
+
+    if data.get("type") in ("heartbeat", "pong"):
+        return
+    elif data.get("type") in EPHEMERAL_TYPES:
+        try:
+            await ephemeral.handle(user_id, data)
+        except ValueError as e:
+            await connection.send_now({"type": "error", "detail": str(e)})
+    elif data.get("type") in ("resume", "fetch", "room", "read") and not connection.authenticated:
+        await connection.send_now({"type": "error", "detail": f"{data['type']} needs an access token on the handshake"})
+    elif data.get("type") == "resume":
+        await resume_session(connection, user_id, data)
+    elif data.get("type") == "fetch":
+        await fetch_missing(connection, user_id, data)
+    elif data.get("type") == "room":
+        room = await rooms.get(data.get("room_id")) if isinstance(data.get("room_id"), str) else None
+        if room is None or not rooms.can_post(room, user_id) or not isinstance(message, str) or not message:
+            await connection.send_now({"type": "error", "detail": "room needs the room_id of a room you belong to and a message"})
+            return
+        await rooms.post(room, user_id, message)
+    elif data.get("type") == "read" and data.get("peer_id"):
+        try:
+            read_cursors.mark_read(user_id, conversation_id_for(user_id, data["peer_id"]), data.get("up_to"))
+        except ValueError as e:
+            await connection.send_now({"type": "error", "detail": str(e)})
+    elif recipient_id and message:
+        # Save message to database
+        conversation_id = conversation_id_for(user_id, recipient_id)
+        message_doc = {
+            "conversation_id": conversation_id,
+            "seq": await sequences.next(conversation_id),
+            "sender_id": user_id,
+            "receiver_id": recipient_id,
+            "content": message,
+            "timestamp": datetime.now().isoformat(),
+            "status": "sent",
+            "is_read": False
+        }
+        # Waits for the group commit in ack mode, only queues in deliver_first mode
+        await message_writer.write(message_doc)
+        logger.info(f"Message queued for persistence: {user_id} -> {recipient_id}")
+
+        # Send to recipient if online on any worker
+        delivered = await message_router.publish(recipient_id, {
+            "from": user_id,
+            "message": message,
+            "timestamp": message_doc["timestamp"],
+            "conversation_id": conversation_id,
+            "seq": message_doc["seq"]
+        })
+        if delivered:
+            logger.info(f"Message sent from {user_id} to {recipient_id}")
+        else:
+            logger.info(f"Recipient {recipient_id} not online")
+    else:
+        logger.warning(f"Invalid message format from {user_id}: {data}")
+
 @app.websocket("/ws/chat/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
+    connection = None
     try:
-        await websocket.accept()
-        active_connections[user_id] = websocket
-        logger.info(f"WebSocket connected for user: {user_id}")
+        try:
+            subject = websocket_token_subject(websocket)
+        except JWTError:
+            subject = ""
+        if subject is not None and subject != user_id:
+            logger.warning(f"Rejecting WebSocket for {user_id}: the access token is invalid or for another user")
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+        # JSON text frames (v1) unless the client offers the MessagePack subprotocol (v2)
+        codec = negotiate(websocket)
+        await websocket.accept(subprotocol=codec.subprotocol)
+        if outbound.at_capacity:
+            outbound.stats["rejected"] += 1
+            logger.warning(f"Rejecting WebSocket for {user_id}: worker holds {outbound.max_connections} connections")
+            await websocket.close(code=CAPACITY_CLOSE_CODE)
+            return
+        connection = outbound.open(user_id, websocket, codec)
+        connection.authenticated = subject == user_id
+        await message_router.subscribe(user_id, connection.send)
+        logger.info(f"WebSocket connected for user: {user_id} (protocol v{codec.version})")
 
-        # Update user status to online
-        await users_collection.update_one(
-            {"_id": ObjectId(user_id)},
-            {"$set": {"is_online": True}}
-        )
+        await presence.connect(user_id)
 
         while True:
             try:
-                data = await websocket.receive_json()
-                recipient_id = data.get("recipient_id")
-                message = data.get("message")
-
-                if recipient_id and message:
-                    # Save message to database
-                    message_doc = {
-                        "sender_id": user_id,
-                        "receiver_id": recipient_id,
-                        "content": message,
-                        "timestamp": datetime.now().isoformat(),
-                        "status": "sent",
-                        "is_read": False
-                    }
-                    await messages_collection.insert_one(message_doc)
-                    logger.info(f"Message saved to database: {user_id} -> {recipient_id}")
-
-                    # Send to recipient if online
-                    if recipient_id in active_connections:
-                        try:
-                            await active_connections[recipient_id].send_json({
-                                "from": user_id,
-                                "message": message,
-                                "timestamp": message_doc["timestamp"]
-                            })
-                            logger.info(f"Message sent from {user_id} to {recipient_id}")
-                        except Exception as e:
-                            logger.error(f"Failed to send message to {recipient_id}: {e}")
-                            # Remove broken connection
-                            if recipient_id in active_connections:
-                                del active_connections[recipient_id]
-                    else:
-                        logger.info(f"Recipient {recipient_id} not online")
-                else:
-                    logger.warning(f"Invalid message format from {user_id}: {data}")
+                frames = await codec.receive(websocket)
+                presence.seen(user_id)
+                connection.touch(pong=any(data.get("type") == "pong" for data in frames if isinstance(data, dict)))
+                for data in frames:
+                    await handle_frame(connection, user_id, data)
             except json.JSONDecodeError as e:
                 logger.error(f"Invalid JSON from {user_id}: {e}")
+            except ProtocolError as e:
+                logger.warning(f"Invalid frame from {user_id}: {e}")
+                await connection.send_now({"type": "error", "detail": str(e)})
             except Exception as e:
                 logger.error(f"Error processing message from {user_id}: {e}")
                 break
@@ -486,44 +1046,45 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
         logger.error(f"WebSocket error for user {user_id}: {e}")
     finally:
         # Clean up
-        if user_id in active_connections:
-            del active_connections[user_id]
+        if connection is not None:
+            connection.close()
+            try:
+                await message_router.unsubscribe(user_id, connection.send)
+            except Exception as e:
+                logger.error(f"Failed to unsubscribe {user_id}: {e}")
 
-        # Update user status to offline
-        try:
-            await users_collection.update_one(
-                {"_id": ObjectId(user_id)},
-                {
-                    "$set": {
-                        "is_online": False,
-                        "last_seen": datetime.now().isoformat()
-                    }
-                }
-            )
-        except Exception as e:
-            logger.error(f"Failed to update user status for {user_id}: {e}")
+            # Update user status to offline
+            try:
+                await presence.disconnect(user_id)
+            except Exception as e:
+                logger.error(f"Failed to update user status for {user_id}: {e}")
+
+@app.post("/api/presence")
+async def query_presence(data: dict = Body(...), current_user: dict = Depends(get_current_user)):
+    user_ids = data.get("user_ids")
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+        raise HTTPException(status_code=400, detail="user_ids must be a list of user ids")
+    if len(user_ids) > PRESENCE_MAX_QUERY:
+        raise HTTPException(status_code=400, detail=f"At most {PRESENCE_MAX_QUERY} user ids per request")
+    try:
+        return await presence.lookup(user_ids)
+    except Exception as e:
+        logger.error(f"Presence query error: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/api/users")
 async def get_all_users():
-    users = []
-    async for user in users_collection.find({}, {"password": 0}):  # Exclude password
-        users.append({
-            "_id": str(user["_id"]),
-            "email": user["email"],
-            "username": user.get("username"),
-            "role": user.get("role", "customer"),
-            "created_at": user.get("created_at"),
-            "last_seen": user.get("last_seen"),
-            "is_online": user.get("is_online", False)
-        })
-    return users
+    # The projection only includes public fields, so the password never leaves Mongo
+    users = await find_documents(users_collection, {}, USER_WITH_ROLE_PROJECTION)
+    return ORJSONListResponse(await presence.apply_presence(users))
 
 # Error handlers
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     return JSONResponse(
         status_code=exc.status_code,
-        content={"detail": exc.detail}
+        content={"detail": exc.detail},
+        headers=getattr(exc, "headers", None)
     )
 
 @app.exception_handler(Exception)
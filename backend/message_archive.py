@@ -0,0 +1,188 @@
+"""Time-partitioned cold storage for old messages.
+
+Messages older than ``ARCHIVE_HOT_DAYS`` are compacted out of the hot
+``messages`` collection into zlib-compressed blocks in ``messages_cold``: one
+or more blocks per conversation per calendar month. The history and export
+paths read both tiers, so only recent messages (and their indexes) need to
+stay in RAM. Blocks whose newest message is older than ``ARCHIVE_RETENTION_DAYS``
+can be purged.
+
+    python message_archive.py compact   # move old messages into cold blocks
+    python message_archive.py purge     # apply the retention policy
+"""
+import asyncio
+import logging
+import os
+import sys
+import zlib
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import bson
+import motor.motor_asyncio
+from bson import Binary, ObjectId
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_HOT_DAYS = int(os.getenv("ARCHIVE_HOT_DAYS", "90"))
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "0"))  # 0 keeps blocks forever
+ARCHIVE_BLOCK_MESSAGES = int(os.getenv("ARCHIVE_BLOCK_MESSAGES", "1000"))
+ARCHIVE_BLOCK_BYTES = 4 * 1024 * 1024
+
+
+def shape_message(message: dict) -> dict:
+    """Same shape as fast_json.MESSAGE_PROJECTION produces for hot messages."""
+    return {
+        "_id": str(message["_id"]),
+        "conversation_id": message.get("conversation_id"),
+        "sender_id": message["sender_id"],
+        "receiver_id": message["receiver_id"],
+        "content": message["content"],
+        "timestamp": message["timestamp"],
+        "status": message.get("status"),
+        "is_read": message.get("is_read"),
+        "read_at": message.get("read_at"),
+        "seq": message.get("seq"),
+    }
+
+
+def _encode_block(messages: List[dict]) -> Binary:
+    return Binary(zlib.compress(b"".join(bson.encode(message) for message in messages)))
+
+
+def decode_block(block: dict) -> List[dict]:
+    return bson.decode_all(zlib.decompress(block["data"]))
+
+
+def _after(message: dict, position: Optional[Tuple[str, ObjectId]], order: str) -> bool:
+    if position is None:
+        return True
+    key = (message["timestamp"], message["_id"])
+    return key < position if order == "desc" else key > position
+
+
+class MessageArchive:
+    def __init__(self, hot_collection, cold_collection):
+        self.hot = hot_collection
+        self.cold = cold_collection
+
+    async def compact(self, hot_days: int = ARCHIVE_HOT_DAYS) -> dict:
+        cutoff = (datetime.now() - timedelta(days=hot_days)).isoformat()
+        report = {"conversations": 0, "blocks": 0, "messages": 0}
+        conversations = self.hot.aggregate([
+            {"$match": {"timestamp": {"$lt": cutoff}, "conversation_id": {"$exists": True}}},
+            {"$group": {"_id": "$conversation_id"}},
+        ], allowDiskUse=True)
+        async for group in conversations:
+            blocks, moved = await self._compact_conversation(group["_id"], cutoff)
+            report["conversations"] += 1
+            report["blocks"] += blocks
+            report["messages"] += moved
+        logger.info(f"Compacted {report['messages']} messages into {report['blocks']} blocks "
+                    f"from {report['conversations']} conversations older than {cutoff}")
+        return report
+
+    async def _compact_conversation(self, conversation_id: str, cutoff: str) -> Tuple[int, int]:
+        # Ids already archived by an earlier run that stopped before deleting them
+        archived = set()
+        async for block in self.cold.find({"conversation_id": conversation_id}, {"message_ids": 1}):
+            archived.update(block["message_ids"])
+
+        blocks = moved = 0
+        pending: List[dict] = []
+        pending_bytes = 0
+        cursor = self.hot.find(
+            {"conversation_id": conversation_id, "timestamp": {"$lt": cutoff}}
+        ).sort([("timestamp", 1), ("_id", 1)])
+        async for message in cursor:
+            if message["_id"] in archived:
+                await self.hot.delete_one({"_id": message["_id"]})
+                continue
+            size = len(bson.encode(message))
+            new_period = pending and pending[0]["timestamp"][:7] != message["timestamp"][:7]
+            if pending and (new_period or len(pending) >= ARCHIVE_BLOCK_MESSAGES
+                            or pending_bytes + size > ARCHIVE_BLOCK_BYTES):
+                await self._write_block(conversation_id, pending)
+                blocks += 1
+                moved += len(pending)
+                pending, pending_bytes = [], 0
+            pending.append(message)
+            pending_bytes += size
+        if pending:
+            await self._write_block(conversation_id, pending)
+            blocks += 1
+            moved += len(pending)
+        return blocks, moved
+
+    async def _write_block(self, conversation_id: str, messages: List[dict]):
+        ids = [message["_id"] for message in messages]
+        await self.cold.insert_one({
+            "conversation_id": conversation_id,
+            "participants": conversation_id.split(":", 1),
+            "period": messages[0]["timestamp"][:7],
+            "start_ts": messages[0]["timestamp"],
+            "end_ts": messages[-1]["timestamp"],
+            "count": len(messages),
+            "message_ids": ids,
+            "data": _encode_block(messages),
+        })
+        # The block is durable before the hot copies go; a crash in between is
+        # cleaned up by the next compaction run via message_ids
+        await self.hot.delete_many({"_id": {"$in": ids}})
+
+    async def purge(self, retention_days: int = ARCHIVE_RETENTION_DAYS) -> int:
+        if retention_days <= 0:
+            return 0
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat()
+        result = await self.cold.delete_many({"end_ts": {"$lt": cutoff}})
+        logger.info(f"Purged {result.deleted_count} cold blocks older than {cutoff}")
+        return result.deleted_count
+
+    async def read_page(self, scope: dict, position: Optional[Tuple[str, ObjectId]], order: str,
+                        limit: int, bound: Optional[str] = None) -> List[dict]:
+        """Up to ``limit`` archived messages matching ``scope`` strictly after ``position``.
+
+        Blocks are visited in time order and decompressed one at a time; the
+        scan stops once no later block can contain a message that sorts before
+        the ``limit``-th candidate. Blocks lying wholly past ``bound`` (a
+        timestamp the caller already has a full page up to) are not read.
+        """
+        if order == "desc":
+            block_query = {**scope, **({"start_ts": {"$lte": position[0]}} if position else {}),
+                           **({"end_ts": {"$gte": bound}} if bound else {})}
+            blocks = self.cold.find(block_query, {"message_ids": 0}).sort("end_ts", -1)
+        else:
+            block_query = {**scope, **({"end_ts": {"$gte": position[0]}} if position else {}),
+                           **({"start_ts": {"$lte": bound}} if bound else {})}
+            blocks = self.cold.find(block_query, {"message_ids": 0}).sort("start_ts", 1)
+
+        candidates: List[dict] = []
+        async for block in blocks:
+            if len(candidates) >= limit:
+                threshold = candidates[limit - 1]["timestamp"]
+                if (order == "desc" and block["end_ts"] < threshold) or \
+                        (order == "asc" and block["start_ts"] > threshold):
+                    break
+            candidates.extend(message for message in decode_block(block) if _after(message, position, order))
+            candidates.sort(key=lambda message: (message["timestamp"], message["_id"]), reverse=order == "desc")
+            del candidates[limit:]
+        return [shape_message(message) for message in candidates]
+
+
+async def main(argv) -> int:
+    if argv not in (["compact"], ["purge"]):
+        print("Usage: python message_archive.py compact | purge")
+        return 1
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    archive = MessageArchive(client.chat_app.messages, client.chat_app.messages_cold)
+    if argv[0] == "compact":
+        report = await archive.compact()
+        print(f"Moved {report['messages']} messages into {report['blocks']} blocks")
+    else:
+        print(f"Purged {await archive.purge()} blocks")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
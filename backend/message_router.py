@@ -0,0 +1,205 @@
+"""Delivery of WebSocket events to users connected to any worker.
+
+Each worker subscribes only for the users connected to it. ``publish`` hands
+an event to the local connection when the recipient is on this worker and
+otherwise publishes it on the recipient's channel, so several uvicorn workers
+or hosts can serve the WebSocket tier without sticky routing.
+
+``fan_out`` delivers one event to many users. Each worker receives it once
+(over a single shared channel) and hands the same ``SharedEvent`` to all of
+its local sockets, so the event is encoded once per worker and protocol.
+"""
+import asyncio
+import logging
+import uuid
+from typing import Awaitable, Callable, Collection, Dict, Iterable, Optional
+
+import orjson
+
+from ws_protocol import SharedEvent
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], Awaitable[None]]
+
+
+FANOUT_CHANNEL = "chat:fanout"
+
+
+def user_channel(user_id: str) -> str:
+    return f"chat:user:{user_id}"
+
+
+class InMemoryRouter:
+    """Routes between connections of a single process; also used in tests."""
+
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+        self._counters = {"local": 0, "remote": 0, "undelivered": 0, "failed": 0,
+                          "fanouts": 0, "fanout_deliveries": 0}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self._handlers.clear()
+
+    async def subscribe(self, user_id: str, handler: Handler):
+        self._handlers[user_id] = handler
+
+    async def unsubscribe(self, user_id: str, handler: Optional[Handler] = None):
+        # A newer connection for the same user may have replaced ``handler``
+        if handler is None or self._handlers.get(user_id) == handler:
+            self._handlers.pop(user_id, None)
+
+    def is_local(self, user_id: str) -> bool:
+        return user_id in self._handlers
+
+    async def _deliver_local(self, user_id: str, event: dict) -> bool:
+        handler = self._handlers.get(user_id)
+        if handler is None:
+            return False
+        try:
+            await handler(event)
+            return True
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.error(f"Failed to deliver event to {user_id}: {e}")
+            return False
+
+    async def publish(self, user_id: str, event: dict) -> bool:
+        """Deliver ``event`` to ``user_id``; returns False when nobody is subscribed."""
+        if await self._deliver_local(user_id, event):
+            self._counters["local"] += 1
+            return True
+        self._counters["undelivered"] += 1
+        return False
+
+    async def _fan_out_local(self, event: SharedEvent, user_ids: Optional[Iterable[str]],
+                             exclude: Collection[str]) -> int:
+        if user_ids is None:
+            targets = list(self._handlers)
+        else:
+            members = user_ids if isinstance(user_ids, (set, frozenset)) else set(user_ids)
+            # Walk whichever side is smaller: a big room on a quiet worker or the reverse
+            if len(members) > len(self._handlers):
+                targets = [user_id for user_id in self._handlers if user_id in members]
+            else:
+                targets = [user_id for user_id in members if user_id in self._handlers]
+        delivered = 0
+        for user_id in targets:
+            # Handlers only queue the event, so this loop never waits on a socket
+            if user_id not in exclude and await self._deliver_local(user_id, event):
+                delivered += 1
+        self._counters["fanout_deliveries"] += delivered
+        return delivered
+
+    async def fan_out(self, event: dict, user_ids: Optional[Iterable[str]] = None,
+                      exclude: Collection[str] = ()) -> int:
+        """Deliver ``event`` to the connected users in ``user_ids`` (everyone when None) but not ``exclude``.
+
+        Returns the number of sockets reached on this worker.
+        """
+        self._counters["fanouts"] += 1
+        return await self._fan_out_local(SharedEvent(event), user_ids, set(exclude))
+
+    def metrics(self) -> dict:
+        return {"backend": "memory", "local_users": len(self._handlers), **self._counters}
+
+
+class RedisRouter(InMemoryRouter):
+    """Routes through Redis pub/sub on ``chat:user:<id>`` channels."""
+
+    def __init__(self, redis):
+        super().__init__()
+        self.redis = redis
+        self._pubsub = redis.pubsub()
+        self._listener: Optional[asyncio.Task] = None
+        # Fan-outs published by this worker come back on the shared channel
+        self.worker_id = uuid.uuid4().hex
+
+    async def start(self):
+        await self._pubsub.subscribe(FANOUT_CHANNEL)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await self._pubsub.close()
+        await super().stop()
+
+    async def subscribe(self, user_id: str, handler: Handler):
+        first = user_id not in self._handlers
+        await super().subscribe(user_id, handler)
+        if first:
+            await self._pubsub.subscribe(user_channel(user_id))
+
+    async def unsubscribe(self, user_id: str, handler: Optional[Handler] = None):
+        await super().unsubscribe(user_id, handler)
+        if user_id not in self._handlers:
+            await self._pubsub.unsubscribe(user_channel(user_id))
+
+    async def publish(self, user_id: str, event: dict) -> bool:
+        # Recipients on this worker skip the Redis round trip
+        if await self._deliver_local(user_id, event):
+            self._counters["local"] += 1
+            return True
+        try:
+            receivers = await self.redis.publish(user_channel(user_id), orjson.dumps(event))
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.error(f"Failed to publish event for {user_id}: {e}")
+            return False
+        if receivers:
+            self._counters["remote"] += 1
+            return True
+        self._counters["undelivered"] += 1
+        return False
+
+    async def fan_out(self, event: dict, user_ids: Optional[Iterable[str]] = None,
+                      exclude: Collection[str] = ()) -> int:
+        if user_ids is not None:
+            user_ids = list(user_ids)
+        exclude = set(exclude)
+        self._counters["fanouts"] += 1
+        delivered = await self._fan_out_local(SharedEvent(event), user_ids, exclude)
+        try:
+            await self.redis.publish(FANOUT_CHANNEL, orjson.dumps({
+                "origin": self.worker_id, "user_ids": user_ids, "exclude": list(exclude), "event": event
+            }))
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.error(f"Failed to publish fan-out: {e}")
+        return delivered
+
+    async def _listen(self):
+        prefix = user_channel("")
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    await asyncio.sleep(0.1)
+                    continue
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message["type"] != "message":
+                    continue
+                channel = message["channel"].decode()
+                if channel == FANOUT_CHANNEL:
+                    fanout = orjson.loads(message["data"])
+                    if fanout["origin"] != self.worker_id:
+                        await self._fan_out_local(SharedEvent(fanout["event"]), fanout["user_ids"],
+                                                  set(fanout["exclude"]))
+                    continue
+                await self._deliver_local(channel[len(prefix):], orjson.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Router listener error: {e}")
+                await asyncio.sleep(1)
+
+    def metrics(self) -> dict:
+        return {**super().metrics(), "backend": "redis"}
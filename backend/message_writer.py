@@ -0,0 +1,324 @@
+import asyncio
+import glob
+import logging
+import os
+import re
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError, WriteError
+
+logger = logging.getLogger(__name__)
+
+# "ack": a write returns once the message is in MongoDB (persist, then deliver).
+# "deliver_first": a write returns once the message is queued; at most
+# MESSAGE_WRITE_MAX_PENDING messages / one flush interval can be lost on a crash.
+MESSAGE_WRITE_MODE = os.getenv("MESSAGE_WRITE_MODE", "ack")
+MESSAGE_WRITE_MAX_BATCH = int(os.getenv("MESSAGE_WRITE_MAX_BATCH", "500"))
+MESSAGE_WRITE_MAX_DELAY_MS = float(os.getenv("MESSAGE_WRITE_MAX_DELAY_MS", "5"))
+MESSAGE_WRITE_MAX_PENDING = int(os.getenv("MESSAGE_WRITE_MAX_PENDING", "10000"))
+MESSAGE_WRITE_RETRIES = int(os.getenv("MESSAGE_WRITE_RETRIES", "3"))
+# "{pid}" gives every worker its own file; files of workers that are gone are replayed on start
+MESSAGE_WRITE_SPILL_PATH = os.getenv("MESSAGE_WRITE_SPILL_PATH", "message_spill.{pid}.ndjson")
+
+DUPLICATE_KEY_ERROR = 11000
+
+Listener = Callable[[List[dict]], Awaitable[None]]
+
+
+def _is_duplicate_id(error: dict) -> bool:
+    if error.get("code") != DUPLICATE_KEY_ERROR:
+        return False
+    if "keyPattern" in error:
+        return list(error["keyPattern"]) == ["_id"]
+    # Servers before 4.2 only name the index in the message
+    return "index: _id_ " in error.get("errmsg", "")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class GroupCommitWriter:
+    """Collects messages from every connection and persists them with insert_many.
+
+    A batch is flushed when it reaches ``max_batch`` messages or when the
+    oldest queued message has waited ``max_delay_ms``. Ids are assigned before
+    queueing, so retries are idempotent: duplicate-key errors on a retry mean
+    the earlier attempt already landed. Batches that still cannot be written
+    are spilled to a local NDJSON file and replayed on the next start. A
+    document the server rejects (e.g. a duplicate ``seq``) fails on its own:
+    the rest of its batch is acknowledged, and unacknowledged rejects go to
+    ``<spill path>.rejected`` instead of being retried forever.
+    Listeners run in their own task, so a slow one delays the statistics it
+    keeps but never the next batch.
+    """
+
+    def __init__(self, collection, mode: str = MESSAGE_WRITE_MODE, max_batch: int = MESSAGE_WRITE_MAX_BATCH,
+                 max_delay_ms: float = MESSAGE_WRITE_MAX_DELAY_MS, max_pending: int = MESSAGE_WRITE_MAX_PENDING,
+                 retries: int = MESSAGE_WRITE_RETRIES, spill_path: str = MESSAGE_WRITE_SPILL_PATH):
+        if mode not in ("ack", "deliver_first"):
+            raise ValueError(f"Unknown message write mode: {mode}")
+        self.collection = collection
+        self.mode = mode
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.max_pending = max_pending
+        self.retries = retries
+        self.spill_template = spill_path
+        self.spill_path = spill_path.replace("{pid}", str(os.getpid()))
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._collecting: List[Tuple[dict, Optional[asyncio.Future]]] = []
+        self._inflight: Optional[asyncio.Future] = None
+        self._listeners: List[Listener] = []
+        self._persisted: Optional[asyncio.Queue] = None
+        self._listener_task: Optional[asyncio.Task] = None
+        self._stats = {"batches": 0, "documents": 0, "flush_time_total": 0.0, "flush_time_max": 0.0,
+                       "retries": 0, "spilled": 0, "replayed": 0, "rejected": 0}
+
+    def add_listener(self, listener: Listener):
+        """Register a coroutine called with every batch after it is persisted."""
+        self._listeners.append(listener)
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._persisted = asyncio.Queue()
+        self._listener_task = asyncio.create_task(self._notify_listeners())
+        await self._replay_spill()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still queued; called on shutdown."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self._inflight is not None:
+            await asyncio.gather(self._inflight, return_exceptions=True)
+        remaining = self._collecting
+        self._collecting = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        for i in range(0, len(remaining), self.max_batch):
+            await self._flush(remaining[i:i + self.max_batch])
+        await self._persisted.join()
+        self._listener_task.cancel()
+        await asyncio.gather(self._listener_task, return_exceptions=True)
+        self._listener_task = None
+        logger.info(f"Message writer stopped after flushing {len(remaining)} queued messages")
+
+    async def write(self, document: dict, wait: Optional[bool] = None) -> dict:
+        """Queue ``document`` for persistence; in ack mode (or ``wait=True``) wait until it is stored."""
+        if self._task is None:
+            await self.start()
+        document.setdefault("_id", ObjectId())
+        if wait is None:
+            wait = self.mode == "ack"
+        future = asyncio.get_running_loop().create_future() if wait else None
+        # A full queue applies backpressure to senders instead of growing the loss window
+        await self._queue.put((document, future))
+        if future is not None:
+            await future
+        return document
+
+    async def _run(self):
+        while True:
+            self._collecting = [await self._queue.get()]
+            self._drain()
+            if len(self._collecting) < self.max_batch and self.max_delay > 0:
+                await asyncio.sleep(self.max_delay)
+                self._drain()
+            batch, self._collecting = self._collecting, []
+            # Shielded so shutdown waits for a flush that has already started
+            self._inflight = asyncio.ensure_future(self._flush(batch))
+            try:
+                await asyncio.shield(self._inflight)
+            except Exception as e:
+                logger.error(f"Message writer flush failed: {e}")
+            self._inflight = None
+
+    def _drain(self):
+        while len(self._collecting) < self.max_batch and not self._queue.empty():
+            self._collecting.append(self._queue.get_nowait())
+
+    async def _insert(self, documents: List[dict], attempt: int) -> Dict[int, dict]:
+        """Insert ``documents``; returns the write errors of those that were not written, by position.
+
+        Raises when the outcome of the whole batch is unknown, which is worth a retry.
+        """
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                raise
+            # On a retry, duplicate _ids are documents the previous attempt already
+            # wrote; a duplicate on any other unique index is a real failure
+            return {error["index"]: error for error in e.details.get("writeErrors", [])
+                    if attempt == 0 or not _is_duplicate_id(error)}
+        return {}
+
+    async def _flush(self, batch: List[Tuple[dict, Optional[asyncio.Future]]]):
+        if not batch:
+            return
+        documents = [document for document, _ in batch]
+        started = time.monotonic()
+        error = None
+        rejected: Dict[int, dict] = {}
+        for attempt in range(self.retries + 1):
+            try:
+                rejected = await self._insert(documents, attempt)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                self._stats["retries"] += 1
+                logger.warning(f"Message batch write failed (attempt {attempt + 1}): {e}")
+                if attempt < self.retries:
+                    await asyncio.sleep(min(0.05 * 2 ** attempt, 1.0))
+
+        elapsed = time.monotonic() - started
+        self._stats["batches"] += 1
+        self._stats["flush_time_total"] += elapsed
+        self._stats["flush_time_max"] = max(self._stats["flush_time_max"], elapsed)
+
+        if error is not None:
+            # Waiting callers are told the write failed; only fire-and-forget
+            # messages, which may already have been delivered, are spilled
+            unacknowledged = []
+            for document, future in batch:
+                if future is None:
+                    unacknowledged.append(document)
+                elif not future.done():
+                    future.set_exception(error)
+            if unacknowledged:
+                self._spill(unacknowledged)
+            return
+
+        unacknowledged = []
+        for position, write_error in rejected.items():
+            document, future = batch[position]
+            logger.error(f"Message {document['_id']} rejected: {write_error.get('errmsg')}")
+            if future is None:
+                unacknowledged.append(document)
+            elif not future.done():
+                future.set_exception(WriteError(write_error.get("errmsg"), write_error.get("code"), write_error))
+        if unacknowledged:
+            self._reject(unacknowledged)
+
+        written = [document for position, (document, _) in enumerate(batch) if position not in rejected]
+        self._stats["documents"] += len(written)
+        for position, (_, future) in enumerate(batch):
+            if position not in rejected and future is not None and not future.done():
+                future.set_result(None)
+        self._notify(written)
+
+    def _notify(self, documents: List[dict]):
+        if self._listeners and documents:
+            self._persisted.put_nowait(documents)
+
+    async def _notify_listeners(self):
+        while True:
+            documents = await self._persisted.get()
+            for listener in self._listeners:
+                try:
+                    await listener(documents)
+                except Exception as e:
+                    logger.error(f"Message writer listener failed: {e}")
+            self._persisted.task_done()
+
+    @staticmethod
+    def _append(path: str, documents: List[dict]):
+        with open(path, "a") as f:
+            for document in documents:
+                f.write(json_util.dumps(document) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _spill(self, documents: List[dict]):
+        self._append(self.spill_path, documents)
+        self._stats["spilled"] += len(documents)
+        logger.error(f"Spilled {len(documents)} messages to {self.spill_path}")
+
+    def _reject(self, documents: List[dict]):
+        # Never replayed; kept for an operator to inspect
+        self._append(f"{self.spill_path}.rejected", documents)
+        self._stats["rejected"] += len(documents)
+        logger.error(f"Moved {len(documents)} unwritable messages to {self.spill_path}.rejected")
+
+    def _adopt_orphaned_spills(self):
+        """Move the spill files of workers that are gone into ours; renaming claims each for one worker."""
+        if "{pid}" not in self.spill_template:
+            return
+        pattern = re.escape(self.spill_template).replace(re.escape("{pid}"), r"(\d+)")
+        for path in glob.glob(self.spill_template.replace("{pid}", "*")):
+            match = re.fullmatch(pattern, path)
+            if path == self.spill_path or match is None or _pid_alive(int(match.group(1))):
+                continue
+            if not os.path.exists(self.spill_path):
+                try:
+                    os.rename(path, self.spill_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            claimed = f"{self.spill_path}.adopting"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            with open(claimed) as source, open(self.spill_path, "a") as f:
+                f.writelines(line for line in source if line.strip())
+                f.flush()
+                os.fsync(f.fileno())
+            os.remove(claimed)
+
+    async def _replay_spill(self):
+        self._adopt_orphaned_spills()
+        if not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path) as f:
+            documents = [json_util.loads(line) for line in f if line.strip()]
+        written, unwritable = [], []
+        try:
+            for i in range(0, len(documents), self.max_batch):
+                chunk = documents[i:i + self.max_batch]
+                # attempt=1: some of these may have been written before the spill
+                rejected = await self._insert(chunk, attempt=1)
+                written.extend(document for position, document in enumerate(chunk) if position not in rejected)
+                unwritable.extend(chunk[position] for position in rejected)
+        except Exception as e:
+            logger.error(f"Could not replay {self.spill_path}, keeping it for the next start: {e}")
+            return
+        if unwritable:
+            self._reject(unwritable)
+        os.remove(self.spill_path)
+        self._stats["replayed"] += len(written)
+        self._notify(written)
+        logger.info(f"Replayed {len(written)} spilled messages from {self.spill_path}")
+
+    def metrics(self) -> dict:
+        batches = self._stats["batches"]
+        return {
+            "mode": self.mode,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "batches": batches,
+            "documents": self._stats["documents"],
+            "avg_batch_size": round(self._stats["documents"] / batches, 2) if batches else 0.0,
+            "flush_time_avg_ms": round(self._stats["flush_time_total"] / batches * 1000, 3) if batches else 0.0,
+            "flush_time_max_ms": round(self._stats["flush_time_max"] * 1000, 3),
+            "retries": self._stats["retries"],
+            "spilled": self._stats["spilled"],
+            "replayed": self._stats["replayed"],
+            "rejected": self._stats["rejected"],
+            "listener_backlog": self._persisted.qsize() if self._persisted else 0,
+        }
@@ -0,0 +1,313 @@
+"""Bounded per-connection outbound queues for WebSocket sends.
+
+Every socket gets a queue drained by its own writer task, so handing an event
+to a recipient never waits on the recipient's network. When a queue is full
+the overflow policy decides what happens:
+
+- ``drop``: the new event is discarded
+- ``coalesce``: replaceable events (typing, read receipts) overwrite the queued
+  one for the same conversation; anything else is dropped as with ``drop``
+- ``disconnect``: the slow client is closed and has to reconnect and resync
+
+While a connection is held for a resume catch-up, live events are queued
+past the limit, up to ``OUTBOUND_HOLD_SIZE`` more, so none are lost to the
+policy. A client that exceeds even that is disconnected to resync.
+
+The registry also pings quiet clients, reaps the ones that stop answering
+and caps the number of sockets one worker accepts.
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_QUEUE_SIZE = int(os.getenv("OUTBOUND_QUEUE_SIZE", "256"))
+OUTBOUND_OVERFLOW_POLICY = os.getenv("OUTBOUND_OVERFLOW_POLICY", "coalesce")
+# Extra events a connection may queue while held for a catch-up
+OUTBOUND_HOLD_SIZE = int(os.getenv("OUTBOUND_HOLD_SIZE", "4096"))
+OUTBOUND_SEND_TIMEOUT = float(os.getenv("OUTBOUND_SEND_TIMEOUT", "10"))
+# Events written per frame by codecs that batch
+OUTBOUND_MAX_BATCH = int(os.getenv("OUTBOUND_MAX_BATCH", "64"))
+OVERFLOW_POLICIES = ("drop", "coalesce", "disconnect")
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "75"))
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "10000"))
+
+# Close code for clients that cannot keep up (policy violation)
+SLOW_CONSUMER_CLOSE_CODE = 1008
+# Close codes for reaped idle clients and for connections over the worker's cap
+IDLE_CLOSE_CODE = 1001
+CAPACITY_CLOSE_CODE = 1013
+
+# Event types where only the latest value per conversation matters
+COALESCIBLE_TYPES = {"typing", "read", "presence", "ping"}
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def coalesce_key(event: dict) -> Optional[Tuple[str, str]]:
+    if event.get("type") not in COALESCIBLE_TYPES:
+        return None
+    return event["type"], event.get("conversation_id") or event.get("from") or ""
+
+
+class OutboundConnection:
+    def __init__(self, user_id: str, websocket, registry: "OutboundRegistry", codec):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.codec = codec
+        self.registry = registry
+        self.connected_at = time.time()
+        self.last_activity = time.monotonic()
+        # v2 clients, and v1 clients once they send a pong, get ping events;
+        # other v1 clients treat every frame as a chat message and are left
+        # to the transport-level pings of the server
+        self.answers_pings = codec.version >= 2
+        # One-item lists so a coalesced event can be swapped without moving it;
+        # the events themselves may be shared with other connections
+        self._queue: Deque[List[dict]] = deque()
+        self._keys: Dict[Tuple[str, str], List[dict]] = {}
+        self._ready = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._closer: Optional[asyncio.Task] = None
+        self.closed = False
+        # Set by the endpoint when the handshake carried an access token for user_id
+        self.authenticated = False
+        self._held = False
+        # Highest seq per conversation already sent by a resume catch-up
+        self._synced: Dict[str, int] = {}
+        self.stats = {"sent": 0, "batches": 0, "dropped": 0, "coalesced": 0, "high_water": 0}
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def start(self):
+        self._writer = asyncio.create_task(self._drain())
+
+    def touch(self, pong: bool = False):
+        """Record inbound activity from the client."""
+        self.last_activity = time.monotonic()
+        if pong:
+            self.answers_pings = True
+
+    async def send(self, event: dict):
+        """Queue ``event`` for this socket; returns immediately whatever the policy."""
+        if self.closed:
+            return
+        key = coalesce_key(event)
+        if key is not None and key in self._keys and self.registry.policy == "coalesce":
+            self._keys[key][0] = event
+            self.stats["coalesced"] += 1
+            return
+        if self._held:
+            if len(self._queue) >= self.registry.max_size + self.registry.hold_size:
+                # Dropping would leave a gap the catch-up does not cover
+                self.registry.stats["slow_disconnects"] += 1
+                logger.warning(f"Disconnecting {self.user_id}: {len(self._queue)} events queued during catch-up")
+                self.close(SLOW_CONSUMER_CLOSE_CODE)
+                return
+        elif len(self._queue) >= self.registry.max_size:
+            if self.registry.policy == "disconnect":
+                self.registry.stats["slow_disconnects"] += 1
+                logger.warning(f"Disconnecting slow client {self.user_id} with {len(self._queue)} queued events")
+                self.close(SLOW_CONSUMER_CLOSE_CODE)
+                return
+            self.stats["dropped"] += 1
+            self.registry.stats["dropped"] += 1
+            return
+        slot = [event]
+        self._queue.append(slot)
+        if key is not None:
+            self._keys[key] = slot
+        self.stats["high_water"] = max(self.stats["high_water"], len(self._queue))
+        if not self._held:
+            self._ready.set()
+
+    def hold(self):
+        """Keep queueing live events but stop writing them, e.g. while a catch-up is streamed."""
+        self._held = True
+        self._ready.clear()
+
+    def release(self, synced: Optional[Dict[str, int]] = None):
+        """Resume writing; queued messages already covered by ``synced`` are skipped."""
+        self._synced.update(synced or {})
+        self._held = False
+        self._ready.set()
+
+    def _already_synced(self, event: dict) -> bool:
+        seq = event.get("seq")
+        return seq is not None and seq <= self._synced.get(event.get("conversation_id"), 0)
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._queue and not self._held:
+                    batch = []
+                    while self._queue and len(batch) < OUTBOUND_MAX_BATCH:
+                        slot = self._queue.popleft()
+                        event = slot[0]
+                        key = coalesce_key(event)
+                        if key is not None and self._keys.get(key) is slot:
+                            del self._keys[key]
+                        if not self._already_synced(event):
+                            batch.append(event)
+                    if batch:
+                        await asyncio.wait_for(self.codec.send(self.websocket, batch), self.registry.send_timeout)
+                        self.stats["sent"] += len(batch)
+                        self.stats["batches"] += 1
+                self._ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self.registry.stats["slow_disconnects"] += 1
+            logger.warning(f"Send to {self.user_id} stalled for {self.registry.send_timeout}s, disconnecting")
+            self.close(SLOW_CONSUMER_CLOSE_CODE)
+        except Exception as e:
+            logger.error(f"Failed to send to {self.user_id}: {e}")
+            self.close()
+
+    async def send_now(self, event: dict):
+        """Write ``event`` from the caller's task, ahead of anything queued."""
+        await asyncio.wait_for(self.codec.send(self.websocket, [event]), self.registry.send_timeout)
+
+    def close(self, code: Optional[int] = None):
+        """Stop the writer; with ``code`` also close the socket, without waiting for it."""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        self._keys.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if code is not None:
+            self._closer = asyncio.create_task(self._close_socket(code))
+        self.registry._connections.discard(self)
+
+    async def _close_socket(self, code: int):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), self.registry.send_timeout)
+        except Exception:
+            pass
+
+    def queued_bytes(self) -> int:
+        return sum(len(orjson.dumps(slot[0])) for slot in self._queue)
+
+    def describe(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "protocol": self.codec.version,
+            "depth": self.depth,
+            "queued_bytes": self.queued_bytes(),
+            "idle_seconds": round(time.monotonic() - self.last_activity, 1),
+            **self.stats,
+        }
+
+
+class OutboundRegistry:
+    def __init__(self, max_size: int = OUTBOUND_QUEUE_SIZE, policy: str = OUTBOUND_OVERFLOW_POLICY,
+                 hold_size: int = OUTBOUND_HOLD_SIZE, send_timeout: float = OUTBOUND_SEND_TIMEOUT, ping_interval: float = WS_PING_INTERVAL,
+                 idle_timeout: float = WS_IDLE_TIMEOUT, max_connections: int = WS_MAX_CONNECTIONS):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"OUTBOUND_OVERFLOW_POLICY must be one of {', '.join(OVERFLOW_POLICIES)}")
+        self.max_size = max_size
+        self.policy = policy
+        self.hold_size = hold_size
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self._connections: Set[OutboundConnection] = set()
+        self._reaper: Optional[asyncio.Task] = None
+        self._baseline_rss: Optional[int] = None
+        self.stats = {"dropped": 0, "slow_disconnects": 0, "idle_reaped": 0, "rejected": 0}
+
+    async def start(self):
+        self._baseline_rss = _rss_bytes()
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+        # Tell clients to reconnect, most likely to another worker
+        connections = list(self._connections)
+        for connection in connections:
+            connection.close(IDLE_CLOSE_CODE)
+        await asyncio.gather(*(c._closer for c in connections if c._closer), return_exceptions=True)
+
+    @property
+    def at_capacity(self) -> bool:
+        return len(self._connections) >= self.max_connections
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            now = time.monotonic()
+            for connection in list(self._connections):
+                if not connection.answers_pings:
+                    continue
+                idle = now - connection.last_activity
+                if idle >= self.idle_timeout:
+                    self.stats["idle_reaped"] += 1
+                    logger.info(f"Closing idle connection of {connection.user_id} after {idle:.0f}s")
+                    connection.close(IDLE_CLOSE_CODE)
+                elif idle >= self.ping_interval:
+                    await connection.send({"type": "ping", "ts": time.time()})
+
+    def open(self, user_id: str, websocket, codec) -> OutboundConnection:
+        connection = OutboundConnection(user_id, websocket, self, codec)
+        self._connections.add(connection)
+        connection.start()
+        return connection
+
+    def memory_report(self) -> dict:
+        """Resident memory attributed to the open connections of this worker.
+
+        ``rss_per_connection`` is the growth since startup divided by the
+        connection count, so it includes the ASGI server's per-socket buffers.
+        """
+        rss = _rss_bytes()
+        count = len(self._connections)
+        growth = rss - self._baseline_rss if rss is not None and self._baseline_rss is not None else None
+        # Shallow size of the per-connection bookkeeping kept by this module
+        bookkeeping = sum(sys.getsizeof(c.__dict__) + sys.getsizeof(c._queue) + sys.getsizeof(c._keys)
+                          for c in self._connections)
+        return {
+            "rss_bytes": rss,
+            "baseline_rss_bytes": self._baseline_rss,
+            "rss_per_connection": growth // count if growth is not None and count else None,
+            "bookkeeping_per_connection": bookkeeping // count if count else None,
+            "queued_bytes": sum(c.queued_bytes() for c in self._connections),
+        }
+
+    def metrics(self, slowest: int = 10) -> dict:
+        depths = [connection.depth for connection in self._connections]
+        return {
+            **self.stats,
+            "policy": self.policy,
+            "max_connections": self.max_connections,
+            "connections": len(depths),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "slowest": [connection.describe() for connection in
+                        sorted(self._connections, key=lambda c: c.depth, reverse=True)[:slowest]
+                        if connection.depth],
+            "memory": self.memory_report(),
+        }
@@ -0,0 +1,50 @@
+import base64
+import json
+from typing import List, Optional, Tuple, Union
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+ORDERS = ("desc", "asc")
+
+
+def encode_cursor(timestamp: str, _id) -> str:
+    """Opaque cursor over the (timestamp, _id) sort key of the last item on a page."""
+    raw = json.dumps([timestamp, str(_id)], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, object_id: bool = True) -> Tuple[str, Union[ObjectId, str]]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, _id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(timestamp), ObjectId(_id) if object_id else str(_id)
+    except (ValueError, TypeError, InvalidId):
+        raise ValueError("Invalid cursor")
+
+
+def sort_spec(order: str, field: str = "timestamp") -> List[Tuple[str, int]]:
+    direction = -1 if order == "desc" else 1
+    return [(field, direction), ("_id", direction)]
+
+
+def keyset_filter(cursor: Optional[str], order: str, field: str = "timestamp", object_id: bool = True) -> dict:
+    """Filter selecting the items strictly after ``cursor`` in ``order``.
+
+    The range on ``field`` is kept as a plain bound so it maps onto the index
+    scan; ties on ``field`` are broken on ``_id`` by the residual ``$nor``.
+    """
+    if not cursor:
+        return {}
+    value, _id = decode_cursor(cursor, object_id)
+    if order == "desc":
+        return {field: {"$lte": value}, "$nor": [{field: value, "_id": {"$gte": _id}}]}
+    return {field: {"$gte": value}, "$nor": [{field: value, "_id": {"$lte": _id}}]}
+
+
+def page_params(limit: int, order: str) -> int:
+    if order not in ORDERS:
+        raise ValueError("order must be 'desc' or 'asc'")
+    return max(1, min(limit, MAX_PAGE_SIZE))
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Union
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_QUEUE_DEPTH = int(os.getenv("PASSWORD_HASH_QUEUE_DEPTH", "64"))
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", "12"))
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full and the caller should back off."""
+
+
+# Worker-side functions. These run in the pool processes, so they must stay
+# module-level (picklable) and report their own timing back to the caller.
+def _hash_in_worker(password: bytes, rounds: int):
+    started = time.time()
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    return hashed, started, time.time() - started
+
+
+def _verify_in_worker(password: bytes, hashed: bytes):
+    started = time.time()
+    try:
+        ok = bcrypt.checkpw(password, hashed)
+    except ValueError:
+        # Malformed stored hash; treat it as a failed login rather than a 500
+        ok = False
+    return ok, started, time.time() - started
+
+
+def _to_bytes(value: Union[str, bytes]) -> bytes:
+    return value.encode() if isinstance(value, str) else value
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS,
+                 queue_depth: int = PASSWORD_HASH_QUEUE_DEPTH,
+                 rounds: int = PASSWORD_HASH_ROUNDS):
+        self.workers = max(1, workers)
+        self.queue_depth = max(self.workers, queue_depth)
+        self.rounds = rounds
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        # Bulk hashing never occupies every worker, so logins are not queued behind an import
+        self._batch_slots: Optional[asyncio.Semaphore] = None
+        self._pending = 0
+        self._stats = {
+            "hash": {"count": 0, "queue_wait_total": 0.0, "queue_wait_max": 0.0,
+                     "work_total": 0.0, "work_max": 0.0},
+            "verify": {"count": 0, "queue_wait_total": 0.0, "queue_wait_max": 0.0,
+                       "work_total": 0.0, "work_max": 0.0},
+        }
+        self._rejected = 0
+
+    def start(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            self._slots = asyncio.Semaphore(self.queue_depth)
+            self._batch_slots = asyncio.Semaphore(max(1, self.workers - 1))
+            logger.info(f"Password hasher started with {self.workers} workers, queue depth {self.queue_depth}")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+            self._slots = None
+            self._batch_slots = None
+
+    def _record(self, kind: str, submitted: float, started: float, elapsed: float):
+        stats = self._stats[kind]
+        queue_wait = max(0.0, started - submitted)
+        stats["count"] += 1
+        stats["queue_wait_total"] += queue_wait
+        stats["queue_wait_max"] = max(stats["queue_wait_max"], queue_wait)
+        stats["work_total"] += elapsed
+        stats["work_max"] = max(stats["work_max"], elapsed)
+
+    async def _submit(self, kind: str, fn, *args, wait: bool = False):
+        self.start()
+        # Interactive callers fail fast when the queue is full; batch callers wait
+        if not wait and self._pending >= self.queue_depth:
+            self._rejected += 1
+            raise PasswordHasherBusy("Password hashing queue is full")
+        async with self._slots:
+            self._pending += 1
+            try:
+                submitted = time.time()
+                loop = asyncio.get_running_loop()
+                result, started, elapsed = await loop.run_in_executor(self._pool, fn, *args)
+                self._record(kind, submitted, started, elapsed)
+                return result
+            finally:
+                self._pending -= 1
+
+    async def hash_password(self, password: Union[str, bytes]) -> bytes:
+        return await self._submit("hash", _hash_in_worker, _to_bytes(password), self.rounds)
+
+    async def verify_password(self, password: Union[str, bytes], hashed: Union[str, bytes]) -> bool:
+        return await self._submit("verify", _verify_in_worker, _to_bytes(password), _to_bytes(hashed))
+
+    async def hash_many(self, passwords: List[Union[str, bytes]]) -> List[bytes]:
+        """Hash a batch one password per job on all but one worker, waiting for queue slots.
+
+        Interactive hashes and verifies are submitted between the batch jobs
+        and find a free worker, so they wait at most one bcrypt round.
+        """
+        self.start()
+
+        async def hash_one(password: bytes) -> bytes:
+            async with self._batch_slots:
+                return await self._submit("hash", _hash_in_worker, password, self.rounds, wait=True)
+
+        return list(await asyncio.gather(*(hash_one(_to_bytes(password)) for password in passwords)))
+
+    def metrics(self) -> dict:
+        report = {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "in_flight": self._pending,
+            "rejected": self._rejected,
+        }
+        for kind, stats in self._stats.items():
+            count = stats["count"]
+            report[kind] = {
+                "count": count,
+                "queue_wait_avg_ms": round(stats["queue_wait_total"] / count * 1000, 3) if count else 0.0,
+                "queue_wait_max_ms": round(stats["queue_wait_max"] * 1000, 3),
+                "hash_time_avg_ms": round(stats["work_total"] / count * 1000, 3) if count else 0.0,
+                "hash_time_max_ms": round(stats["work_max"] * 1000, 3),
+            }
+        return report
+
+
+password_hasher = PasswordHasher()
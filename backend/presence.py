@@ -0,0 +1,254 @@
+"""Online presence with heartbeat expiry and batched ``last_seen`` writes.
+
+A user is online while some worker keeps refreshing their presence entry;
+each worker refreshes the users connected to it every
+``PRESENCE_HEARTBEAT_INTERVAL`` seconds and entries lapse after
+``PRESENCE_TTL``, so users of a crashed worker go offline on their own.
+The store also counts open sockets per user across workers, and a user is
+marked offline only when their last socket closes.
+``last_seen`` is coalesced in memory and written to Mongo in one bulk write
+every ``PRESENCE_FLUSH_INTERVAL`` seconds; ``is_online`` is no longer stored.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", "60"))
+PRESENCE_HEARTBEAT_INTERVAL = float(os.getenv("PRESENCE_HEARTBEAT_INTERVAL", "20"))
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "30"))
+PRESENCE_MAX_QUERY = 1000
+
+
+class InMemoryPresenceStore:
+    """Presence expiries and socket counts held in this process. Also the stand-in used in tests."""
+
+    def __init__(self):
+        self._expires: Dict[str, float] = {}
+        self._sockets: Counter = Counter()
+
+    async def touch(self, user_ids: Iterable[str], expires_at: float):
+        for user_id in user_ids:
+            self._expires[user_id] = expires_at
+
+    async def add_socket(self, user_id: str, expires_at: float):
+        self._sockets[user_id] += 1
+        self._expires[user_id] = expires_at
+
+    async def remove_sockets(self, user_id: str, count: int = 1):
+        self._sockets[user_id] -= count
+        if self._sockets[user_id] <= 0:
+            del self._sockets[user_id]
+            self._expires.pop(user_id, None)
+
+    async def online(self, user_ids: List[str], now: float) -> Dict[str, bool]:
+        return {user_id: self._expires.get(user_id, 0) > now for user_id in user_ids}
+
+    async def prune(self, now: float):
+        for user_id, expires_at in list(self._expires.items()):
+            if expires_at <= now:
+                del self._expires[user_id]
+                self._sockets.pop(user_id, None)
+
+
+class RedisPresenceStore:
+    """Presence shared by every worker: a sorted set of user ids scored by expiry
+    and a hash of open sockets per user."""
+
+    # KEYS: online set, socket counts; ARGV: user id, sockets closed
+    REMOVE_SCRIPT = """
+local left = redis.call('HINCRBY', KEYS[2], ARGV[1], -tonumber(ARGV[2]))
+if left <= 0 then
+  redis.call('HDEL', KEYS[2], ARGV[1])
+  redis.call('ZREM', KEYS[1], ARGV[1])
+end
+return left
+"""
+    # Counts of lapsed users belong to crashed workers and would keep them online forever
+    PRUNE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #expired > 0 then
+  redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+  redis.call('HDEL', KEYS[2], unpack(expired))
+end
+return #expired
+"""
+
+    def __init__(self, redis, key: str = "presence:online"):
+        self.redis = redis
+        self.key = key
+        self.sockets_key = f"{key}:sockets"
+        self._remove = redis.register_script(self.REMOVE_SCRIPT)
+        self._prune = redis.register_script(self.PRUNE_SCRIPT)
+
+    async def touch(self, user_ids: Iterable[str], expires_at: float):
+        mapping = {user_id: expires_at for user_id in user_ids}
+        if mapping:
+            await self.redis.zadd(self.key, mapping)
+
+    async def add_socket(self, user_id: str, expires_at: float):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hincrby(self.sockets_key, user_id, 1)
+        pipe.zadd(self.key, {user_id: expires_at})
+        await pipe.execute()
+
+    async def remove_sockets(self, user_id: str, count: int = 1):
+        await self._remove(keys=[self.key, self.sockets_key], args=[user_id, count])
+
+    async def online(self, user_ids: List[str], now: float) -> Dict[str, bool]:
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zscore(self.key, user_id)
+        scores = await pipe.execute()
+        return {user_id: score is not None and score > now for user_id, score in zip(user_ids, scores)}
+
+    async def prune(self, now: float):
+        await self._prune(keys=[self.key, self.sockets_key], args=[now])
+
+
+class PresenceTracker:
+    def __init__(self, users_collection, store, ttl: float = PRESENCE_TTL,
+                 heartbeat_interval: float = PRESENCE_HEARTBEAT_INTERVAL,
+                 flush_interval: float = PRESENCE_FLUSH_INTERVAL):
+        self.users_collection = users_collection
+        self.store = store
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.flush_interval = flush_interval
+        # Open sockets per user on this worker
+        self._connections: Counter = Counter()
+        self._last_seen: Dict[str, str] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._stats = {"heartbeats": 0, "flushes": 0, "writes": 0}
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._heartbeat_loop()), asyncio.create_task(self._flush_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # This worker's users are about to lose their sockets
+        for user_id in list(self._connections):
+            count = self._connections.pop(user_id)
+            self.seen(user_id)
+            await self.store.remove_sockets(user_id, count)
+        await self.flush()
+
+    def seen(self, user_id: str):
+        """Record activity for ``last_seen``; cheap enough to call on every frame."""
+        self._last_seen[str(user_id)] = datetime.now().isoformat()
+
+    async def heartbeat(self, user_id: str):
+        """Mark ``user_id`` online for another ``ttl`` seconds."""
+        user_id = str(user_id)
+        self.seen(user_id)
+        await self.store.touch([user_id], time.time() + self.ttl)
+        self._stats["heartbeats"] += 1
+
+    async def connect(self, user_id: str):
+        user_id = str(user_id)
+        self._connections[user_id] += 1
+        self.seen(user_id)
+        await self.store.add_socket(user_id, time.time() + self.ttl)
+        self._stats["heartbeats"] += 1
+
+    async def disconnect(self, user_id: str):
+        user_id = str(user_id)
+        self.seen(user_id)
+        self._connections[user_id] -= 1
+        if self._connections[user_id] <= 0:
+            del self._connections[user_id]
+        # The store takes the user offline once no worker holds a socket for them
+        await self.store.remove_sockets(user_id)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                now = time.time()
+                await self.store.touch(list(self._connections), now + self.ttl)
+                await self.store.prune(now)
+            except Exception as e:
+                logger.error(f"Presence heartbeat failed: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Presence flush failed: {e}")
+
+    async def flush(self):
+        if not self._last_seen:
+            return
+        pending, self._last_seen = self._last_seen, {}
+        operations = []
+        for user_id, last_seen in pending.items():
+            try:
+                operations.append(UpdateOne({"_id": ObjectId(user_id)}, {"$max": {"last_seen": last_seen}}))
+            except InvalidId:
+                continue
+        if not operations:
+            return
+        try:
+            await self.users_collection.bulk_write(operations, ordered=False)
+        except Exception:
+            for user_id, last_seen in pending.items():
+                if last_seen > self._last_seen.get(user_id, ""):
+                    self._last_seen[user_id] = last_seen
+            raise
+        self._stats["flushes"] += 1
+        self._stats["writes"] += len(operations)
+
+    async def lookup(self, user_ids: List[str], stored_last_seen: Optional[Dict[str, Optional[str]]] = None) -> Dict[str, dict]:
+        """``{user_id: {"is_online", "last_seen"}}`` for many users in one round trip.
+
+        ``stored_last_seen`` holds values the caller already read from Mongo;
+        without it they are fetched here.
+        """
+        user_ids = [str(user_id) for user_id in user_ids]
+        online = await self.store.online(user_ids, time.time())
+        if stored_last_seen is None:
+            object_ids = []
+            for user_id in user_ids:
+                try:
+                    object_ids.append(ObjectId(user_id))
+                except InvalidId:
+                    pass
+            stored_last_seen = {
+                str(user["_id"]): user.get("last_seen")
+                async for user in self.users_collection.find({"_id": {"$in": object_ids}}, {"last_seen": 1})
+            }
+        presence = {}
+        for user_id in user_ids:
+            last_seen = stored_last_seen.get(user_id)
+            # Values not flushed yet are already visible to readers on this worker
+            pending = self._last_seen.get(user_id)
+            if pending and pending > (last_seen or ""):
+                last_seen = pending
+            presence[user_id] = {"is_online": online[user_id], "last_seen": last_seen}
+        return presence
+
+    async def apply_presence(self, users: List[dict]) -> List[dict]:
+        """Overwrite ``is_online``/``last_seen`` on serialized users with live presence."""
+        presence = await self.lookup([user["_id"] for user in users],
+                                     {str(user["_id"]): user.get("last_seen") for user in users})
+        for user in users:
+            user.update(presence[str(user["_id"])])
+        return users
+
+    def metrics(self) -> dict:
+        return {**self._stats, "local_users": len(self._connections), "pending": len(self._last_seen)}
@@ -0,0 +1,110 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import bson
+from bson import ObjectId
+
+from redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "30"))
+PRINCIPAL_CACHE_REDIS_TTL = int(os.getenv("PRINCIPAL_CACHE_REDIS_TTL", "300"))
+
+# Password hashes never enter the cache
+PRINCIPAL_PROJECTION = {"password": 0}
+
+
+class PrincipalCache:
+    """TTL/LRU cache of authenticated user documents keyed by user id.
+
+    The in-process tier is always on. When Redis is configured a second tier
+    is shared between workers; the local TTL is kept short so an invalidation
+    on one worker is picked up by the others quickly.
+    """
+
+    def __init__(self, users_collection, max_size: int = PRINCIPAL_CACHE_SIZE,
+                 ttl: float = PRINCIPAL_CACHE_TTL, redis_ttl: int = PRINCIPAL_CACHE_REDIS_TTL):
+        self.users_collection = users_collection
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_ttl = redis_ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._counters = {"local_hits": 0, "redis_hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    @staticmethod
+    def _redis_key(user_id: str) -> str:
+        return f"principal:{user_id}"
+
+    def _get_local(self, user_id: str) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return user
+
+    def _put_local(self, user_id: str, user: dict):
+        self._entries[user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        user = self._get_local(user_id)
+        if user is not None:
+            self._counters["local_hits"] += 1
+            return user
+
+        redis = get_redis()
+        if redis is not None:
+            try:
+                raw = await redis.get(self._redis_key(user_id))
+                if raw is not None:
+                    user = bson.decode(raw)
+                    self._counters["redis_hits"] += 1
+                    self._put_local(user_id, user)
+                    return user
+            except Exception as e:
+                logger.warning(f"Principal cache Redis read failed: {e}")
+
+        self._counters["misses"] += 1
+        user = await self.users_collection.find_one({"_id": ObjectId(user_id)}, PRINCIPAL_PROJECTION)
+        if user is None:
+            return None
+        self._put_local(user_id, user)
+        if redis is not None:
+            try:
+                await redis.set(self._redis_key(user_id), bson.encode(user), ex=self.redis_ttl)
+            except Exception as e:
+                logger.warning(f"Principal cache Redis write failed: {e}")
+        return user
+
+    async def invalidate(self, user_id) -> None:
+        user_id = str(user_id)
+        self._entries.pop(user_id, None)
+        self._counters["invalidations"] += 1
+        redis = get_redis()
+        if redis is not None:
+            try:
+                await redis.delete(self._redis_key(user_id))
+            except Exception as e:
+                logger.warning(f"Principal cache Redis invalidation failed: {e}")
+
+    def metrics(self) -> dict:
+        hits = self._counters["local_hits"] + self._counters["redis_hits"]
+        total = hits + self._counters["misses"]
+        return {
+            **self._counters,
+            "size": len(self._entries),
+            "hit_ratio": round(hits / total, 4) if total else 0.0,
+            "redis_enabled": get_redis() is not None,
+        }
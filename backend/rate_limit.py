@@ -0,0 +1,185 @@
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+LOGIN_RATE_PER_IP = float(os.getenv("LOGIN_RATE_PER_IP", "1.0"))
+LOGIN_BURST_PER_IP = int(os.getenv("LOGIN_BURST_PER_IP", "20"))
+LOGIN_RATE_PER_EMAIL = float(os.getenv("LOGIN_RATE_PER_EMAIL", "0.1"))
+LOGIN_BURST_PER_EMAIL = int(os.getenv("LOGIN_BURST_PER_EMAIL", "5"))
+LOGIN_MAX_CONCURRENT = int(os.getenv("LOGIN_MAX_CONCURRENT", "32"))
+TRUST_FORWARDED_FOR = os.getenv("TRUST_FORWARDED_FOR", "false").lower() == "true"
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+# (key, capacity, refill rate per second) of one bucket
+Bucket = Tuple[str, int, float]
+
+
+class InMemoryBucketStore:
+    """Token buckets held in this process. Also the stand-in used in tests."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated), least recently used first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take_all(self, buckets: List[Bucket], cost: float = 1.0) -> List[float]:
+        now = time.monotonic()
+        levels = []
+        for key, capacity, rate in buckets:
+            tokens, updated = self._buckets.get(key, (float(capacity), now))
+            levels.append(min(capacity, tokens + (now - updated) * rate))
+        retry_afters = [max(0.0, (cost - tokens) / rate) for tokens, (_, _, rate) in zip(levels, buckets)]
+        taken = cost if not any(retry_afters) else 0.0
+        for tokens, (key, _, _) in zip(levels, buckets):
+            self._buckets[key] = (tokens - taken, now)
+            self._buckets.move_to_end(key)
+        # The least recently used buckets have had longest to refill, so forgetting them costs least
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_afters
+
+
+class RedisBucketStore:
+    """Token buckets shared by every worker, updated atomically in Lua."""
+
+    SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local levels = {}
+local retries = {}
+local rejected = false
+for i, key in ipairs(KEYS) do
+  local capacity = tonumber(ARGV[2 * i + 1])
+  local rate = tonumber(ARGV[2 * i + 2])
+  local state = redis.call('HMGET', key, 'tokens', 'ts')
+  local tokens = tonumber(state[1])
+  local ts = tonumber(state[2])
+  if tokens == nil then
+    tokens = capacity
+    ts = now
+  end
+  tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+  levels[i] = tokens
+  retries[i] = 0
+  if tokens < cost then
+    retries[i] = (cost - tokens) / rate
+    rejected = true
+  end
+end
+for i, key in ipairs(KEYS) do
+  local tokens = levels[i]
+  if not rejected then
+    tokens = tokens - cost
+  end
+  local capacity = tonumber(ARGV[2 * i + 1])
+  local rate = tonumber(ARGV[2 * i + 2])
+  redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+  redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000))
+  retries[i] = tostring(retries[i])
+end
+return retries
+"""
+
+    def __init__(self, redis, prefix: str = "ratelimit"):
+        self.redis = redis
+        self.prefix = prefix
+        self._script = redis.register_script(self.SCRIPT)
+
+    async def take_all(self, buckets: List[Bucket], cost: float = 1.0) -> List[float]:
+        args = [time.time(), cost]
+        for _, capacity, rate in buckets:
+            args.extend([capacity, rate])
+        retry_afters = await self._script(keys=[f"{self.prefix}:{key}" for key, _, _ in buckets], args=args)
+        return [float(retry_after) for retry_after in retry_afters]
+
+
+class TokenBucketLimiter:
+    def __init__(self, name: str, capacity: int, rate: float, store):
+        self.name = name
+        self.capacity = capacity
+        self.rate = rate
+        self.store = store
+        self._allowed = 0
+        self._rejected = 0
+
+    async def check(self, key: str):
+        """Take one token for ``key`` or raise RateLimited."""
+        await check_all([(self, key)])
+
+    def metrics(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "rate_per_second": self.rate,
+            "allowed": self._allowed,
+            "rejected": self._rejected,
+        }
+
+
+async def check_all(checks: List[Tuple[TokenBucketLimiter, str]]):
+    """Take one token from every limiter's bucket for its key, or none if any of them would reject.
+
+    The limiters must share a store; the buckets are checked and updated in one step.
+    """
+    store = checks[0][0].store
+    try:
+        retry_afters = await store.take_all([(f"{limiter.name}:{key}", limiter.capacity, limiter.rate)
+                                             for limiter, key in checks])
+    except Exception as e:
+        # Fail open: a broken limiter backend must not lock everyone out
+        logger.error(f"Rate limiter {', '.join(limiter.name for limiter, _ in checks)} backend error: {e}")
+        return
+    if any(retry_afters):
+        for (limiter, _), retry_after in zip(checks, retry_afters):
+            if retry_after > 0:
+                limiter._rejected += 1
+        raise RateLimited(max(retry_afters))
+    for limiter, _ in checks:
+        limiter._allowed += 1
+
+
+class ConcurrencyGate:
+    """Caps in-flight work and sheds the excess instead of queueing it."""
+
+    def __init__(self, limit: int, retry_after: float = 1.0):
+        self.limit = limit
+        self.retry_after = retry_after
+        self._in_flight = 0
+        self._shed = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._in_flight >= self.limit:
+            self._shed += 1
+            raise RateLimited(self.retry_after)
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+
+    def metrics(self) -> dict:
+        return {"limit": self.limit, "in_flight": self._in_flight, "shed": self._shed}
+
+
+def retry_after_header(retry_after: float) -> str:
+    return str(max(1, math.ceil(retry_after)))
+
+
+def client_ip(request) -> str:
+    if TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+READ_CURSOR_FLUSH_INTERVAL = float(os.getenv("READ_CURSOR_FLUSH_INTERVAL", "1.0"))
+
+Key = Tuple[str, str]
+Listener = Callable[[Dict[Key, str]], Awaitable[None]]
+
+
+def cursor_id(reader_id: str, conversation_id: str) -> str:
+    return f"{reader_id}|{conversation_id}"
+
+
+def parse_read_timestamp(up_to: Optional[str]) -> str:
+    """Normalize a client-supplied read mark; marks in the future are capped at now."""
+    now = datetime.now()
+    if up_to is None:
+        return now.isoformat()
+    if not isinstance(up_to, str):
+        raise ValueError("up_to must be an ISO 8601 timestamp")
+    try:
+        parsed = datetime.fromisoformat(up_to)
+    except ValueError:
+        raise ValueError("up_to must be an ISO 8601 timestamp")
+    if parsed.tzinfo is not None:
+        # Message timestamps are naive local time
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return min(parsed, now).isoformat()
+
+
+class ReadCursorStore:
+    """Read state as one high-water mark per (reader, conversation).
+
+    A message is read when its timestamp is at or below the receiver's cursor
+    for that conversation. Marks are coalesced in memory and flushed every
+    ``flush_interval`` seconds with ``$max``, so a burst of read events for
+    the same conversation costs a single upsert.
+    """
+
+    def __init__(self, collection, flush_interval: float = READ_CURSOR_FLUSH_INTERVAL):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self._pending: Dict[Key, str] = {}
+        self._listeners: List[Listener] = []
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"marks": 0, "flushes": 0, "writes": 0}
+
+    def add_listener(self, listener: Listener):
+        """Register a coroutine called with ``{(reader, conversation): timestamp}`` after each flush."""
+        self._listeners.append(listener)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    def mark_read(self, reader_id: str, conversation_id: str, up_to: Optional[str] = None):
+        """Move the cursor to ``up_to`` (default now); raises ValueError unless it is an ISO timestamp."""
+        up_to = parse_read_timestamp(up_to)
+        key = (str(reader_id), conversation_id)
+        if up_to > self._pending.get(key, ""):
+            self._pending[key] = up_to
+        self._stats["marks"] += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Read cursor flush failed: {e}")
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = datetime.now().isoformat()
+        operations = [
+            UpdateOne(
+                {"_id": cursor_id(reader_id, conversation_id)},
+                {
+                    "$max": {"last_read_at": up_to},
+                    "$set": {"reader_id": reader_id, "conversation_id": conversation_id, "updated_at": now}
+                },
+                upsert=True
+            )
+            for (reader_id, conversation_id), up_to in pending.items()
+        ]
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception:
+            # Put the marks back so the next flush retries them
+            for key, up_to in pending.items():
+                if up_to > self._pending.get(key, ""):
+                    self._pending[key] = up_to
+            raise
+        self._stats["flushes"] += 1
+        self._stats["writes"] += len(operations)
+        for listener in self._listeners:
+            try:
+                await listener(pending)
+            except Exception as e:
+                logger.error(f"Read cursor listener failed: {e}")
+
+    async def get_cursors(self, keys: Iterable[Key]) -> Dict[Key, str]:
+        keys = set(keys)
+        if not keys:
+            return {}
+        cursors = {}
+        async for cursor in self.collection.find(
+            {"_id": {"$in": [cursor_id(reader_id, conversation_id) for reader_id, conversation_id in keys]}},
+            {"reader_id": 1, "conversation_id": 1, "last_read_at": 1}
+        ):
+            cursors[(cursor["reader_id"], cursor["conversation_id"])] = cursor["last_read_at"]
+        # Marks not flushed yet are already visible to readers on this worker
+        for key in keys:
+            pending = self._pending.get(key)
+            if pending and pending > cursors.get(key, ""):
+                cursors[key] = pending
+        return cursors
+
+    async def apply_read_state(self, messages: List[dict]) -> List[dict]:
+        """Derive ``is_read``/``status`` for serialized messages from the receivers' cursors."""
+        keys = {(message["receiver_id"], message["conversation_id"])
+                for message in messages if message.get("conversation_id")}
+        cursors = await self.get_cursors(keys)
+        for message in messages:
+            cursor = cursors.get((message["receiver_id"], message.get("conversation_id")))
+            if cursor and message["timestamp"] <= cursor:
+                message["is_read"] = True
+                message["status"] = "read"
+        return messages
+
+    def metrics(self) -> dict:
+        return {**self._stats, "pending": len(self._pending)}
@@ -0,0 +1,30 @@
+import logging
+import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+REDIS_HOST = os.getenv("REDIS_HOST")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+
+_redis = None
+
+
+def get_redis() -> Optional["redis.asyncio.Redis"]:
+    """Shared async Redis client, or None when REDIS_HOST is not configured."""
+    global _redis
+    if _redis is None and REDIS_HOST:
+        import redis.asyncio as redis
+
+        _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD)
+        logger.info(f"Using Redis at {REDIS_HOST}:{REDIS_PORT}")
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.close()
+        _redis = None
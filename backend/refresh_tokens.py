@@ -0,0 +1,69 @@
+import hashlib
+import logging
+import os
+import secrets
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+
+
+def _hash_token(token: str) -> str:
+    # Only the digest is stored, so a leaked collection cannot be replayed
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class RefreshTokenStore:
+    """Server-side refresh tokens with rotation and reuse detection.
+
+    Every refresh consumes the presented token and issues a new one in the
+    same family. Presenting an already-consumed token revokes the family.
+    Expired documents are removed by the TTL index on ``expires_at``
+    declared in ``indexes.py``.
+    """
+
+    def __init__(self, collection, expire_days: int = REFRESH_TOKEN_EXPIRE_DAYS):
+        self.collection = collection
+        self.expire_days = expire_days
+
+    async def issue(self, user_id: str, family_id: Optional[str] = None) -> str:
+        token = secrets.token_urlsafe(32)
+        now = datetime.utcnow()
+        await self.collection.insert_one({
+            "_id": _hash_token(token),
+            "user_id": user_id,
+            "family_id": family_id or uuid.uuid4().hex,
+            "created_at": now,
+            "expires_at": now + timedelta(days=self.expire_days),
+            "used_at": None
+        })
+        return token
+
+    async def rotate(self, token: str) -> Optional[Tuple[str, str]]:
+        """Consume ``token`` and return ``(user_id, new_token)``, or None if invalid."""
+        token_hash = _hash_token(token)
+        now = datetime.utcnow()
+        current = await self.collection.find_one_and_update(
+            {"_id": token_hash, "used_at": None, "expires_at": {"$gt": now}},
+            {"$set": {"used_at": now}},
+            return_document=ReturnDocument.BEFORE
+        )
+        if current is None:
+            stale = await self.collection.find_one({"_id": token_hash})
+            if stale and stale.get("used_at"):
+                logger.warning(f"Refresh token reuse detected for user {stale['user_id']}, revoking family")
+                await self.collection.delete_many({"family_id": stale["family_id"]})
+            return None
+
+        new_token = await self.issue(current["user_id"], current["family_id"])
+        return current["user_id"], new_token
+
+    async def revoke(self, token: str):
+        stale = await self.collection.find_one({"_id": _hash_token(token)})
+        if stale:
+            await self.collection.delete_many({"family_id": stale["family_id"]})
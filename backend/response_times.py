@@ -0,0 +1,280 @@
+"""Admin response times, measured per conversation and kept as quantile sketches.
+
+A response is the first message in a conversation from someone other than
+the previous sender. Its response time runs from the first message of the
+previous sender's run of messages to the response. Responses by admins are
+added to a sketch per (admin, day) in ``response_time_sketches``. The sketch
+counts values in logarithmic buckets, so any quantile is within
+``RESPONSE_SKETCH_ACCURACY`` of the true value. Sketches are persisted with
+``$inc`` and merge by adding buckets, so percentiles over any set of admins
+and days are computed without reading messages.
+
+    python response_times.py rebuild   # measure existing messages from scratch
+"""
+import asyncio
+import logging
+import math
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import motor.motor_asyncio
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_SKETCH_ACCURACY = float(os.getenv("RESPONSE_SKETCH_ACCURACY", "0.01"))
+ADMIN_REFRESH_INTERVAL = 300
+MAX_QUERY_DAYS = 366
+# Responses faster than this count as zero
+MIN_RESPONSE_SECONDS = 0.001
+REBUILD_BATCH_SIZE = 1000
+DUPLICATE_KEY_ERROR = 11000
+
+# Display bins for the histogram: (label, upper bound in seconds)
+HISTOGRAM_BINS = [
+    ("<1m", 60), ("1-5m", 300), ("5-15m", 900), ("15-60m", 3600),
+    ("1-4h", 4 * 3600), ("4-24h", 86400), (">24h", math.inf),
+]
+
+
+def sketch_id(admin_id: str, day: str) -> str:
+    return f"{admin_id}|{day}"
+
+
+class ResponseSketch:
+    """Log-bucketed histogram with relative accuracy ``accuracy`` for every quantile."""
+
+    def __init__(self, accuracy: float = RESPONSE_SKETCH_ACCURACY):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = defaultdict(int)
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        if seconds < MIN_RESPONSE_SECONDS:
+            self.zero += 1
+        else:
+            self.buckets[math.ceil(math.log(seconds) / self._log_gamma)] += 1
+
+    def merge_document(self, document: dict):
+        self.count += document.get("count", 0)
+        self.sum += document.get("sum", 0.0)
+        self.zero += document.get("zero", 0)
+        for index, count in document.get("buckets", {}).items():
+            self.buckets[int(index)] += count
+
+    def increments(self) -> dict:
+        """The ``$inc`` document adding this sketch to a stored one."""
+        increments = {"count": self.count, "sum": self.sum, "zero": self.zero}
+        increments.update({f"buckets.{index}": count for index, count in self.buckets.items()})
+        return increments
+
+    def _value(self, index: int) -> float:
+        # Bucket i holds (gamma^(i-1), gamma^i]; this point is within the accuracy of both ends
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        # Nearest rank: the smallest value with at least q of the values at or below it
+        rank = max(0, math.ceil(q * self.count) - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return self._value(index)
+        return self._value(max(self.buckets))
+
+    def histogram(self) -> Dict[str, int]:
+        bins = {label: 0 for label, _ in HISTOGRAM_BINS}
+        bins[HISTOGRAM_BINS[0][0]] += self.zero
+        for index, count in self.buckets.items():
+            value = self._value(index)
+            label = next(label for label, upper in HISTOGRAM_BINS if value < upper)
+            bins[label] += count
+        return bins
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "histogram": self.histogram(),
+        }
+
+
+def _seconds_between(earlier: str, later: str) -> float:
+    return (datetime.fromisoformat(later) - datetime.fromisoformat(earlier)).total_seconds()
+
+
+class ResponseTimeTracker:
+    def __init__(self, state_collection, sketches_collection, users_collection):
+        # Per conversation: who sent the latest run of messages and when it started
+        self.state_collection = state_collection
+        self.sketches_collection = sketches_collection
+        self.users_collection = users_collection
+        self._admins: Set[str] = set()
+        self._admins_loaded_at = 0.0
+        self._stats = {"batches": 0, "responses": 0}
+
+    async def _admin_ids(self) -> Set[str]:
+        if time.monotonic() - self._admins_loaded_at > ADMIN_REFRESH_INTERVAL:
+            self._admins = {str(_id) for _id in await self.users_collection.distinct("_id", {"role": "admin"})}
+            self._admins_loaded_at = time.monotonic()
+        return self._admins
+
+    async def on_messages(self, messages: List[dict]):
+        """Message writer listener: measure the responses in a persisted batch."""
+        by_conversation: Dict[str, List[dict]] = defaultdict(list)
+        for message in messages:
+            if message.get("conversation_id"):
+                by_conversation[message["conversation_id"]].append(message)
+        if not by_conversation:
+            return
+        states = {
+            state["_id"]: state
+            async for state in self.state_collection.find({"_id": {"$in": list(by_conversation)}})
+        }
+        sketches, states = self._measure(by_conversation, states, await self._admin_ids())
+        await self._write(sketches, states)
+        self._stats["batches"] += 1
+
+    def _measure(self, by_conversation: Dict[str, List[dict]], states: Dict[str, dict],
+                 admins: Set[str]) -> Tuple[Dict[Tuple[str, str], ResponseSketch], Dict[str, dict]]:
+        sketches: Dict[Tuple[str, str], ResponseSketch] = defaultdict(ResponseSketch)
+        new_states = {}
+        for conversation_id, conversation in by_conversation.items():
+            state = states.get(conversation_id) or {}
+            last_sender, run_started = state.get("last_sender"), state.get("run_started")
+            for message in sorted(conversation, key=lambda m: m["timestamp"]):
+                if message["sender_id"] == last_sender:
+                    continue
+                if last_sender is not None and message["sender_id"] in admins:
+                    seconds = _seconds_between(run_started, message["timestamp"])
+                    # A late batch can predate the stored run; that gap is not a response
+                    if seconds >= 0:
+                        sketches[(message["sender_id"], message["timestamp"][:10])].add(seconds)
+                        self._stats["responses"] += 1
+                last_sender, run_started = message["sender_id"], message["timestamp"]
+            new_states[conversation_id] = {"last_sender": last_sender, "run_started": run_started}
+        return sketches, new_states
+
+    async def _write(self, sketches: Dict[Tuple[str, str], ResponseSketch], states: Dict[str, dict]):
+        if sketches:
+            await self.sketches_collection.bulk_write([
+                UpdateOne({"_id": sketch_id(admin_id, day)},
+                          {"$inc": sketch.increments(), "$setOnInsert": {"admin_id": admin_id, "day": day}},
+                          upsert=True)
+                for (admin_id, day), sketch in sketches.items()
+            ], ordered=False)
+        if not states:
+            return
+        # Workers write concurrently; state from an older batch must not move a run back. When
+        # the stored run is newer the filter misses and the upsert fails on _id, which is ignored
+        try:
+            await self.state_collection.bulk_write([
+                UpdateOne({"_id": conversation_id, "$or": [{"run_started": {"$lte": state["run_started"]}},
+                                                           {"run_started": {"$exists": False}}]},
+                          {"$set": state}, upsert=True)
+                for conversation_id, state in states.items()
+            ], ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+
+    async def query(self, start_day: str, end_day: str, admin_ids: Optional[Iterable[str]] = None) -> dict:
+        """Merged percentiles and histograms for ``start_day`` to ``end_day`` (inclusive), per admin and overall."""
+        try:
+            start, end = datetime.fromisoformat(start_day), datetime.fromisoformat(end_day)
+        except ValueError:
+            raise ValueError("Days must be YYYY-MM-DD")
+        if end < start or (end - start).days >= MAX_QUERY_DAYS:
+            raise ValueError(f"The range must run forwards and span at most {MAX_QUERY_DAYS} days")
+        query = {"day": {"$gte": start_day, "$lte": end_day}}
+        if admin_ids is not None:
+            query["admin_id"] = {"$in": list(admin_ids)}
+        overall = ResponseSketch()
+        per_admin: Dict[str, ResponseSketch] = defaultdict(ResponseSketch)
+        async for document in self.sketches_collection.find(query):
+            overall.merge_document(document)
+            per_admin[document["admin_id"]].merge_document(document)
+        return {
+            "from": start_day,
+            "to": end_day,
+            "accuracy": RESPONSE_SKETCH_ACCURACY,
+            "overall": overall.summary(),
+            "admins": {admin_id: sketch.summary() for admin_id, sketch in per_admin.items()},
+        }
+
+    async def mean(self, start_day: str) -> float:
+        """Mean response time of all admins since ``start_day``; 0 without responses."""
+        totals = {"count": 0, "sum": 0.0}
+        async for document in self.sketches_collection.find({"day": {"$gte": start_day}}, {"count": 1, "sum": 1}):
+            totals["count"] += document["count"]
+            totals["sum"] += document["sum"]
+        return totals["sum"] / totals["count"] if totals["count"] else 0
+
+    async def rebuild(self, messages_collection, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+        """Drop all sketches and measure every stored message again."""
+        await self.sketches_collection.delete_many({})
+        await self.state_collection.delete_many({})
+        admins = await self._admin_ids()
+        measured = 0
+        states: Dict[str, dict] = {}
+        pending: Dict[str, List[dict]] = defaultdict(list)
+        cursor = messages_collection.find(
+            {"conversation_id": {"$exists": True}},
+            {"conversation_id": 1, "sender_id": 1, "timestamp": 1}
+        ).sort([("conversation_id", -1), ("timestamp", 1)]).batch_size(batch_size)
+        async for message in cursor:
+            pending[message["conversation_id"]].append(message)
+            measured += 1
+            if measured % batch_size == 0:
+                states = await self._rebuild_batch(pending, states, admins)
+                pending = defaultdict(list)
+        await self._rebuild_batch(pending, states, admins)
+        return measured
+
+    async def _rebuild_batch(self, pending: Dict[str, List[dict]], states: Dict[str, dict],
+                             admins: Set[str]) -> Dict[str, dict]:
+        if not pending:
+            return states
+        sketches, new_states = self._measure(pending, states, admins)
+        await self._write(sketches, new_states)
+        # Messages arrive grouped by conversation, so only the last one can continue into the next batch
+        last = next(reversed(pending))
+        logger.info(f"Measured responses up to conversation {last}")
+        return {last: new_states[last]}
+
+    def metrics(self) -> dict:
+        return dict(self._stats)
+
+
+async def main(argv) -> int:
+    if argv != ["rebuild"]:
+        print("Usage: python response_times.py rebuild")
+        return 1
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    db = client.chat_app
+    tracker = ResponseTimeTracker(db.response_time_state, db.response_time_sketches, db.users)
+    measured = await tracker.rebuild(db.messages)
+    print(f"Measured {measured} messages; {tracker.metrics()['responses']} admin responses recorded")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
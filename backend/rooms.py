@@ -0,0 +1,132 @@
+"""Group rooms and admin announcements.
+
+A room message is stored once in ``room_messages`` with the ``room_id`` it
+belongs to; who receives it is the room's member list, not a copy per
+recipient. Delivery goes through ``fan_out`` on the message router, which
+encodes the event once and queues it on every member socket. The
+announcements room has no member list: its messages reach every connected
+customer and only admins may post to it.
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+ANNOUNCEMENTS_ROOM = "announcements"
+ROOM_MAX_MEMBERS = int(os.getenv("ROOM_MAX_MEMBERS", "1000"))
+ROOM_NAME_MAX_LENGTH = 100
+
+ANNOUNCEMENTS = {"_id": ANNOUNCEMENTS_ROOM, "kind": "announcements", "name": "Announcements", "members": []}
+
+
+def sequence_key(room_id: str) -> str:
+    # Shares the conversation counters; the prefix keeps room ids from colliding with "a:b" keys
+    return f"room:{room_id}"
+
+
+def _member_ids(user_ids: Iterable) -> List[str]:
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, str) and user_id for user_id in user_ids):
+        raise ValueError("Members must be a list of user ids")
+    return list(dict.fromkeys(user_ids))
+
+
+class Rooms:
+    def __init__(self, collection, messages_collection, users_collection, sequences, router):
+        self.collection = collection
+        self.messages_collection = messages_collection
+        self.users_collection = users_collection
+        self.sequences = sequences
+        self.router = router
+        self._stats = {"messages": 0, "fanouts": 0, "deliveries": 0, "fanout_ms_last": 0.0, "fanout_ms_max": 0.0}
+
+    async def create(self, name: str, created_by: str, member_ids: list) -> dict:
+        if not isinstance(name, str) or not name.strip() or len(name) > ROOM_NAME_MAX_LENGTH:
+            raise ValueError(f"Room name must be 1 to {ROOM_NAME_MAX_LENGTH} characters")
+        members = _member_ids([created_by, *member_ids] if isinstance(member_ids, list) else member_ids)
+        if len(members) > ROOM_MAX_MEMBERS:
+            raise ValueError(f"A room holds at most {ROOM_MAX_MEMBERS} members")
+        room = {
+            "_id": str(ObjectId()),
+            "kind": "group",
+            "name": name.strip(),
+            "members": members,
+            "created_by": created_by,
+            "created_at": datetime.now().isoformat(),
+        }
+        await self.collection.insert_one(room)
+        return room
+
+    async def get(self, room_id: str) -> Optional[dict]:
+        if room_id == ANNOUNCEMENTS_ROOM:
+            return ANNOUNCEMENTS
+        return await self.collection.find_one({"_id": room_id})
+
+    async def update_members(self, room: dict, add: list, remove: list) -> dict:
+        add, remove = _member_ids(add), _member_ids(remove)
+        if len((set(room["members"]) | set(add)) - set(remove)) > ROOM_MAX_MEMBERS:
+            raise ValueError(f"A room holds at most {ROOM_MAX_MEMBERS} members")
+        # One pipeline update, so concurrent changes are applied to the stored list
+        return await self.collection.find_one_and_update(
+            {"_id": room["_id"]},
+            [{"$set": {"members": {"$setDifference": [{"$setUnion": ["$members", add]}, remove]}}}],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def can_read(room: dict, user_id: str, is_admin: bool = False) -> bool:
+        return room["kind"] == "announcements" or is_admin or user_id in room["members"]
+
+    @staticmethod
+    def can_post(room: dict, user_id: str, is_admin: bool = False) -> bool:
+        if room["kind"] == "announcements":
+            return is_admin
+        return user_id in room["members"]
+
+    async def post(self, room: dict, sender_id: str, content: str) -> Tuple[dict, int]:
+        """Store ``content`` once and deliver it to the room's connected members.
+
+        Returns the stored message and the number of sockets reached on this worker.
+        """
+        room_id = room["_id"]
+        message = {
+            "_id": ObjectId(),
+            "room_id": room_id,
+            "seq": await self.sequences.next(sequence_key(room_id)),
+            "sender_id": sender_id,
+            "content": content,
+            "timestamp": datetime.now().isoformat(),
+        }
+        await self.messages_collection.insert_one(message)
+        self._stats["messages"] += 1
+
+        event = {
+            "type": "room_message",
+            "room_id": room_id,
+            "from": sender_id,
+            "message": content,
+            "timestamp": message["timestamp"],
+            "seq": message["seq"],
+        }
+        if room["kind"] == "announcements":
+            admins = {str(admin_id) for admin_id in await self.users_collection.distinct("_id", {"role": "admin"})}
+        started = time.perf_counter()
+        if room["kind"] == "announcements":
+            delivered = await self.router.fan_out(event, exclude=admins)
+        else:
+            delivered = await self.router.fan_out(event, room["members"], exclude={sender_id})
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._stats["fanouts"] += 1
+        self._stats["deliveries"] += delivered
+        self._stats["fanout_ms_last"] = round(elapsed_ms, 3)
+        self._stats["fanout_ms_max"] = max(self._stats["fanout_ms_max"], round(elapsed_ms, 3))
+        logger.info(f"Room message in {room_id} from {sender_id} reached {delivered} local sockets in {elapsed_ms:.1f} ms")
+        return {**message, "_id": str(message["_id"])}, delivered
+
+    def metrics(self) -> dict:
+        return dict(self._stats)
@@ -0,0 +1,194 @@
+"""Message search.
+
+Customers search through ``search_entries``: one entry per message and
+participant holding the message's distinct terms and a copy of the message.
+The message writer adds entries for every persisted batch, so a search is
+one query on ``(user_id, terms, timestamp)`` covering all of the user's
+conversations, hot and archived, and reads at most one page of entries.
+Entries match every query term exactly and come newest first. Admins
+searching all messages use the MongoDB text index on ``content``, ranked by
+relevance.
+
+    python search.py rebuild   # index existing and archived messages
+    python search.py purge     # drop entries past ARCHIVE_RETENTION_DAYS
+"""
+import asyncio
+import base64
+import logging
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import motor.motor_asyncio
+from pymongo import ReplaceOne
+
+from fast_json import MESSAGE_PROJECTION, find_documents
+from message_archive import ARCHIVE_RETENTION_DAYS, decode_block, shape_message
+
+logger = logging.getLogger(__name__)
+
+SEARCH_MAX_OFFSET = 1000
+SEARCH_MAX_QUERY_LENGTH = 200
+SEARCH_MAX_QUERY_TERMS = 10
+# Distinct terms indexed per message
+SEARCH_MAX_TERMS = 100
+REBUILD_BATCH_SIZE = 1000
+
+SEARCH_PROJECTION = {**MESSAGE_PROJECTION, "score": {"$meta": "textScore"}}
+SEARCH_SORT = [("score", {"$meta": "textScore"}), ("timestamp", -1), ("_id", -1)]
+
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+
+def query_terms(query: str) -> List[str]:
+    return [term.lower() for term in _TERM.findall(query)]
+
+
+def highlight_spans(content: str, terms: List[str]) -> List[List[int]]:
+    """Character ranges in ``content`` matching a query term.
+
+    Terms match as word prefixes so stemmed hits ("deliver" -> "delivered")
+    are still highlighted.
+    """
+    if not terms:
+        return []
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+    return [[match.start(), match.end()] for match in pattern.finditer(content)]
+
+
+def encode_offset(offset: int) -> str:
+    return base64.urlsafe_b64encode(str(offset).encode()).decode().rstrip("=")
+
+
+def decode_offset(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        offset = int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if offset < 0 or offset > SEARCH_MAX_OFFSET:
+        raise ValueError("Invalid cursor")
+    return offset
+
+
+def index_terms(content: str) -> List[str]:
+    return list(dict.fromkeys(query_terms(content)))[:SEARCH_MAX_TERMS]
+
+
+def entry_id(user_id: str, message_id) -> str:
+    return f"{user_id}|{message_id}"
+
+
+class SearchIndex:
+    def __init__(self, collection):
+        self.collection = collection
+
+    @staticmethod
+    def _entries(messages: List[dict]) -> List[ReplaceOne]:
+        operations = []
+        for message in messages:
+            shaped = shape_message(message)
+            terms = index_terms(shaped["content"])
+            if not terms:
+                continue
+            for user_id in (shaped["sender_id"], shaped["receiver_id"]):
+                # Replacing by a fixed _id keeps replayed batches and rebuilds idempotent
+                operations.append(ReplaceOne({"_id": entry_id(user_id, shaped["_id"])}, {
+                    "user_id": user_id,
+                    "terms": terms,
+                    "timestamp": shaped["timestamp"],
+                    "message": shaped,
+                }, upsert=True))
+        return operations
+
+    async def on_messages(self, messages: List[dict]):
+        """Message writer listener: index a persisted batch for both participants."""
+        operations = self._entries(messages)
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+
+    async def search(self, participant_id: str, terms: List[str], limit: int, offset: int = 0) -> List[dict]:
+        """Up to ``limit`` messages of ``participant_id`` containing every term, newest first."""
+        cursor = self.collection.find(
+            {"user_id": participant_id, "terms": {"$all": terms}}, {"message": 1}
+        ).sort([("timestamp", -1), ("_id", -1)]).skip(offset).limit(limit)
+        return [entry["message"] async for entry in cursor]
+
+    async def rebuild(self, messages_collection, cold_collection, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+        """Index every hot and archived message; existing entries are overwritten."""
+        indexed = 0
+        batch = []
+        async for message in messages_collection.find({}).batch_size(batch_size):
+            batch.append(message)
+            if len(batch) >= batch_size:
+                await self.on_messages(batch)
+                indexed += len(batch)
+                batch = []
+        await self.on_messages(batch)
+        indexed += len(batch)
+        async for block in cold_collection.find({}, {"message_ids": 0}).batch_size(10):
+            messages = decode_block(block)
+            await self.on_messages(messages)
+            indexed += len(messages)
+            logger.info(f"Indexed {indexed} messages")
+        return indexed
+
+    async def purge(self, retention_days: int = ARCHIVE_RETENTION_DAYS) -> int:
+        """Drop entries for messages the archive retention policy has removed."""
+        if retention_days <= 0:
+            return 0
+        cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat()
+        result = await self.collection.delete_many({"timestamp": {"$lt": cutoff}})
+        return result.deleted_count
+
+
+async def search_messages(collection, search_index: SearchIndex, query: str, participant_id: Optional[str],
+                          limit: int, offset: int = 0) -> Tuple[List[dict], Optional[int]]:
+    """Messages matching ``query`` in every conversation of ``participant_id``.
+
+    None searches all messages through the text index (admins). Returns the
+    page and the offset of the next page, if any.
+    """
+    if len(query) > SEARCH_MAX_QUERY_LENGTH:
+        raise ValueError(f"Query is longer than {SEARCH_MAX_QUERY_LENGTH} characters")
+    terms = list(dict.fromkeys(query_terms(query)))
+    if not terms:
+        raise ValueError("Query has no searchable terms")
+    if len(terms) > SEARCH_MAX_QUERY_TERMS:
+        raise ValueError(f"Query has more than {SEARCH_MAX_QUERY_TERMS} terms")
+
+    if participant_id is None:
+        results = await find_documents(collection, {"$text": {"$search": query}}, SEARCH_PROJECTION,
+                                       sort=SEARCH_SORT, skip=offset, limit=limit + 1, batch_size=limit + 1)
+    else:
+        results = await search_index.search(participant_id, terms, limit + 1, offset)
+    next_offset = None
+    if len(results) > limit:
+        results = results[:limit]
+        if offset + limit <= SEARCH_MAX_OFFSET:
+            next_offset = offset + limit
+    for result in results:
+        result["highlights"] = highlight_spans(result["content"], terms)
+    return results, next_offset
+
+
+async def main(argv) -> int:
+    if argv not in (["rebuild"], ["purge"]):
+        print("Usage: python search.py rebuild | purge")
+        return 1
+    client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    db = client.chat_app
+    search_index = SearchIndex(db.search_entries)
+    if argv[0] == "rebuild":
+        print(f"Indexed {await search_index.rebuild(db.messages, db.messages_cold)} messages")
+    else:
+        print(f"Purged {await search_index.purge()} search entries")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1:])))
@@ -0,0 +1,231 @@
+"""Admin dashboard statistics kept current on the write path.
+
+Total customers, total messages, messages per day and the last message time
+of every sender are counters updated as users are created and message
+batches are persisted, so ``/api/admin/stats`` reads a few numbers instead
+of querying MongoDB. Active senders are the ones with a message in the last
+24 hours. Every ``STATS_RECONCILE_INTERVAL`` seconds one worker recounts
+from MongoDB and overwrites the counters, correcting drift from imports,
+compaction, purges or writes that raced the previous recount. The average
+response time is the mean of the admin response-time sketches since
+yesterday; see response_times.py.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STATS_RECONCILE_INTERVAL = float(os.getenv("STATS_RECONCILE_INTERVAL", "300"))
+ACTIVE_WINDOW = 24 * 3600
+
+
+def _day(timestamp: str) -> str:
+    return timestamp[:10]
+
+
+def _epoch(timestamp: str) -> float:
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+class InMemoryStatsStore:
+    """Counters for a single process. Also the stand-in used in tests."""
+
+    def __init__(self):
+        self._totals = {"total_users": 0, "total_messages": 0, "average_response_time": 0.0}
+        self._days: Dict[str, int] = {}
+        # sender -> last message time, plus a heap of (time, sender) to expire them in order;
+        # heap entries superseded by a later message are skipped when they surface
+        self._senders: Dict[str, float] = {}
+        self._expiry: List[Tuple[float, str]] = []
+        self._reconciled_at: Optional[float] = None
+
+    async def add_users(self, count: int):
+        self._totals["total_users"] += count
+
+    async def add_messages(self, per_day: Dict[str, int], senders: Dict[str, float]):
+        self._totals["total_messages"] += sum(per_day.values())
+        for day, count in per_day.items():
+            self._days[day] = self._days.get(day, 0) + count
+        for sender_id, sent_at in senders.items():
+            if sent_at > self._senders.get(sender_id, 0):
+                self._senders[sender_id] = sent_at
+                heapq.heappush(self._expiry, (sent_at, sender_id))
+        if len(self._expiry) > 2 * len(self._senders) + 1024:
+            self._expiry = [(sent_at, sender_id) for sender_id, sent_at in self._senders.items()]
+            heapq.heapify(self._expiry)
+
+    async def replace(self, totals: dict, today: str, messages_today: int, senders: Dict[str, float]):
+        self._totals.update(totals)
+        self._days = {today: messages_today}
+        self._senders = dict(senders)
+        self._expiry = [(sent_at, sender_id) for sender_id, sent_at in senders.items()]
+        heapq.heapify(self._expiry)
+        self._reconciled_at = time.time()
+
+    async def read(self, today: str, active_since: float) -> dict:
+        while self._expiry and self._expiry[0][0] < active_since:
+            sent_at, sender_id = heapq.heappop(self._expiry)
+            if self._senders.get(sender_id) == sent_at:
+                del self._senders[sender_id]
+        return {
+            **self._totals,
+            "messages_today": self._days.get(today, 0),
+            "active_users": len(self._senders),
+            "reconciled_at": self._reconciled_at,
+        }
+
+    async def lead(self, interval: float) -> bool:
+        return True
+
+
+class RedisStatsStore:
+    """Counters shared by every worker: a hash of totals, a counter per day and a sorted set of senders."""
+
+    def __init__(self, redis, prefix: str = "stats"):
+        self.redis = redis
+        self.totals_key = f"{prefix}:totals"
+        self.senders_key = f"{prefix}:active_senders"
+        self.lock_key = f"{prefix}:reconcile_lock"
+        self.prefix = prefix
+
+    def _day_key(self, day: str) -> str:
+        return f"{self.prefix}:messages:{day}"
+
+    async def add_users(self, count: int):
+        await self.redis.hincrby(self.totals_key, "total_users", count)
+
+    async def add_messages(self, per_day: Dict[str, int], senders: Dict[str, float]):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrby(self.totals_key, "total_messages", sum(per_day.values()))
+        for day, count in per_day.items():
+            pipe.incrby(self._day_key(day), count)
+            pipe.expire(self._day_key(day), 3 * 86400)
+        if senders:
+            pipe.zadd(self.senders_key, senders, gt=True)
+        await pipe.execute()
+
+    async def replace(self, totals: dict, today: str, messages_today: int, senders: Dict[str, float]):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self.totals_key, mapping={**totals, "reconciled_at": time.time()})
+        pipe.set(self._day_key(today), messages_today, ex=3 * 86400)
+        pipe.delete(self.senders_key)
+        if senders:
+            pipe.zadd(self.senders_key, senders)
+        await pipe.execute()
+
+    async def read(self, today: str, active_since: float) -> dict:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(self.totals_key)
+        pipe.get(self._day_key(today))
+        pipe.zremrangebyscore(self.senders_key, "-inf", f"({active_since}")
+        pipe.zcard(self.senders_key)
+        totals, messages_today, _, active = await pipe.execute()
+        totals = {key.decode(): float(value) for key, value in totals.items()}
+        return {
+            "total_users": int(totals.get("total_users", 0)),
+            "total_messages": int(totals.get("total_messages", 0)),
+            "average_response_time": totals.get("average_response_time", 0.0),
+            "messages_today": int(messages_today or 0),
+            "active_users": active,
+            "reconciled_at": totals.get("reconciled_at"),
+        }
+
+    async def lead(self, interval: float) -> bool:
+        # Only the worker holding the lock recounts during an interval
+        return bool(await self.redis.set(self.lock_key, "1", nx=True, ex=max(1, int(interval))))
+
+
+class StatsEngine:
+    def __init__(self, users_collection, messages_collection, cold_collection, store, response_times,
+                 reconcile_interval: float = STATS_RECONCILE_INTERVAL):
+        self.users_collection = users_collection
+        self.messages_collection = messages_collection
+        self.cold_collection = cold_collection
+        self.store = store
+        self.response_times = response_times
+        self.reconcile_interval = reconcile_interval
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"reconciles": 0, "reconcile_seconds_last": 0.0, "updates": 0}
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._reconcile_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def on_users_created(self, role: str = "customer", count: int = 1):
+        if role == "customer" and count:
+            await self.store.add_users(count)
+
+    async def on_messages(self, messages):
+        """Message writer listener: count a persisted batch."""
+        per_day: Dict[str, int] = {}
+        senders: Dict[str, float] = {}
+        # Replayed spill batches can be old; they must not look active
+        active_since = time.time() - ACTIVE_WINDOW
+        for message in messages:
+            timestamp = message["timestamp"]
+            per_day[_day(timestamp)] = per_day.get(_day(timestamp), 0) + 1
+            sent_at = _epoch(timestamp)
+            if sent_at >= active_since and sent_at > senders.get(message["sender_id"], 0):
+                senders[message["sender_id"]] = sent_at
+        await self.store.add_messages(per_day, senders)
+        self._stats["updates"] += 1
+
+    async def snapshot(self) -> dict:
+        now = datetime.now()
+        stats = await self.store.read(now.date().isoformat(), now.timestamp() - ACTIVE_WINDOW)
+        if stats["reconciled_at"] is None:
+            # Nothing counted yet on a fresh store; pay for one recount
+            await self.reconcile()
+            stats = await self.store.read(now.date().isoformat(), now.timestamp() - ACTIVE_WINDOW)
+        return stats
+
+    async def _reconcile_loop(self):
+        while True:
+            try:
+                if await self.store.lead(self.reconcile_interval):
+                    await self.reconcile()
+            except Exception as e:
+                logger.error(f"Stats reconcile failed: {e}")
+            await asyncio.sleep(self.reconcile_interval)
+
+    async def reconcile(self):
+        started = time.perf_counter()
+        now = datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+        since = (now - timedelta(seconds=ACTIVE_WINDOW)).isoformat()
+
+        total_users = await self.users_collection.count_documents({"role": "customer"})
+        archived = 0
+        async for group in self.cold_collection.aggregate([{"$group": {"_id": None, "count": {"$sum": "$count"}}}]):
+            archived = group["count"]
+        total_messages = await self.messages_collection.count_documents({}) + archived
+        messages_today = await self.messages_collection.count_documents({"timestamp": {"$gte": today}})
+        senders = {
+            group["_id"]: _epoch(group["last"])
+            async for group in self.messages_collection.aggregate([
+                {"$match": {"timestamp": {"$gte": since}}},
+                {"$group": {"_id": "$sender_id", "last": {"$max": "$timestamp"}}},
+            ])
+        }
+
+        await self.store.replace(
+            {"total_users": total_users, "total_messages": total_messages,
+             "average_response_time": await self.response_times.mean((now - timedelta(days=1)).date().isoformat())},
+            now.date().isoformat(), messages_today, senders
+        )
+        self._stats["reconciles"] += 1
+        self._stats["reconcile_seconds_last"] = round(time.perf_counter() - started, 3)
+
+    def metrics(self) -> dict:
+        return dict(self._stats)
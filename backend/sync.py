@@ -0,0 +1,142 @@
+"""Per-conversation sequence numbers and catch-up for reconnecting clients.
+
+Every new message gets the next ``seq`` of its conversation. A client that
+reconnects sends its last seen ``seq`` per conversation in a ``resume``
+frame and receives what it missed in batches before live delivery starts;
+a ``fetch`` frame re-requests a range when it notices a gap. A sequence
+number allocated for a message that was never persisted stays a gap, and
+messages written before sequences existed have no ``seq``.
+"""
+import asyncio
+import logging
+import os
+from typing import AsyncIterator, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from fast_json import MESSAGE_PROJECTION, find_documents
+
+logger = logging.getLogger(__name__)
+
+RESUME_BATCH_SIZE = int(os.getenv("RESUME_BATCH_SIZE", "100"))
+# Beyond this a conversation is truncated and the client pages history over REST
+RESUME_MAX_MESSAGES = int(os.getenv("RESUME_MAX_MESSAGES", "1000"))
+FETCH_MAX_RANGE = 1000
+
+
+class SequenceAllocator:
+    """Hands out per-conversation sequence numbers from a counters collection.
+
+    Requests for the same conversation made in the same event loop tick share
+    one ``$inc``, so a burst in a busy conversation costs a single round trip.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._waiting: Dict[str, List[asyncio.Future]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"allocated": 0, "round_trips": 0}
+
+    async def next(self, conversation_id: str) -> int:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(conversation_id, []).append(future)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._allocate())
+        return await future
+
+    async def _allocate(self):
+        # Requests arriving while a round trip is in flight form the next batch
+        while self._waiting:
+            # Yield once so every request made in this tick joins the batch
+            await asyncio.sleep(0)
+            waiting, self._waiting = self._waiting, {}
+            await asyncio.gather(*(self._allocate_for(conversation_id, futures)
+                                   for conversation_id, futures in waiting.items()))
+
+    async def _allocate_for(self, conversation_id: str, futures: List[asyncio.Future]):
+        try:
+            for attempt in range(2):
+                try:
+                    counter = await self.collection.find_one_and_update(
+                        {"_id": conversation_id},
+                        {"$inc": {"seq": len(futures)}},
+                        upsert=True,
+                        return_document=ReturnDocument.AFTER
+                    )
+                    break
+                except DuplicateKeyError:
+                    # Two first allocations raced on the upsert; the retry is a plain update
+                    if attempt:
+                        raise
+            self._stats["round_trips"] += 1
+            self._stats["allocated"] += len(futures)
+            first = counter["seq"] - len(futures) + 1
+            for offset, future in enumerate(futures):
+                if not future.done():
+                    future.set_result(first + offset)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    def metrics(self) -> dict:
+        return dict(self._stats)
+
+
+def participant_of(conversation_id: str, user_id: str) -> bool:
+    return user_id in conversation_id.split(":", 1)
+
+
+async def missed_messages(messages_collection, summaries_collection, user_id: str, cursors: Dict[str, int],
+                          since: Optional[str]) -> AsyncIterator[dict]:
+    """Yield ``sync`` frames with the messages ``user_id`` has not seen.
+
+    Conversations in ``cursors`` resume after their sequence number, read
+    straight from the ``(conversation_id, seq)`` index: the inbox summaries
+    are updated after the fact and may not show a message yet. With ``since``
+    the summaries only discover the other conversations active after that
+    time, which are included from ``since`` on.
+    """
+    for conversation_id, after in cursors.items():
+        if not participant_of(conversation_id, user_id):
+            continue
+        query = {"conversation_id": conversation_id, "seq": {"$gt": after}}
+        async for frame in _sync_frames(messages_collection, conversation_id, query, [("seq", 1)]):
+            yield frame
+    if not since:
+        return
+    summaries = summaries_collection.find({"user_id": user_id, "last_message_at": {"$gt": since},
+                                           "conversation_id": {"$nin": list(cursors)}},
+                                          {"conversation_id": 1})
+    async for summary in summaries:
+        conversation_id = summary["conversation_id"]
+        query = {"conversation_id": conversation_id, "timestamp": {"$gt": since}}
+        async for frame in _sync_frames(messages_collection, conversation_id, query,
+                                        [("timestamp", 1), ("_id", 1)]):
+            yield frame
+
+
+async def _sync_frames(messages_collection, conversation_id: str, query: dict, sort: list) -> AsyncIterator[dict]:
+    messages = await find_documents(messages_collection, query, MESSAGE_PROJECTION, sort=sort,
+                                    limit=RESUME_MAX_MESSAGES + 1, batch_size=RESUME_BATCH_SIZE)
+    truncated = len(messages) > RESUME_MAX_MESSAGES
+    messages = messages[:RESUME_MAX_MESSAGES]
+    for start in range(0, len(messages), RESUME_BATCH_SIZE):
+        last_batch = start + RESUME_BATCH_SIZE >= len(messages)
+        yield {
+            "type": "sync",
+            "conversation_id": conversation_id,
+            "messages": messages[start:start + RESUME_BATCH_SIZE],
+            "more": not last_batch,
+            "truncated": truncated and last_batch,
+        }
+
+
+async def fetch_range(messages_collection, conversation_id: str, from_seq: int, to_seq: int) -> List[dict]:
+    """Messages with ``from_seq <= seq <= to_seq``; missing numbers were never persisted."""
+    if from_seq < 1 or to_seq < from_seq or to_seq - from_seq >= FETCH_MAX_RANGE:
+        raise ValueError(f"Invalid range; at most {FETCH_MAX_RANGE} sequence numbers per fetch")
+    return await find_documents(messages_collection,
+                                {"conversation_id": conversation_id, "seq": {"$gte": from_seq, "$lte": to_seq}},
+                                MESSAGE_PROJECTION, sort=[("seq", 1)])
@@ -0,0 +1,195 @@
+import asyncio
+import os
+
+import pytest
+from bson import ObjectId, json_util
+from pymongo.errors import AutoReconnect, BulkWriteError, WriteError
+
+from message_writer import DUPLICATE_KEY_ERROR, GroupCommitWriter
+
+
+class StubCollection:
+    """insert_many with unordered semantics and unique _id and (conversation_id, seq)."""
+
+    def __init__(self, failures: int = 0, partial: int = 0):
+        self.documents = {}
+        self.failures = failures
+        self.partial = partial
+
+    async def insert_many(self, documents, ordered=True):
+        if self.failures:
+            self.failures -= 1
+            # The server wrote some of the batch before the connection dropped
+            for document in documents[:self.partial]:
+                self.documents.setdefault(document["_id"], document)
+            raise AutoReconnect("connection reset")
+        errors = []
+        seqs = {(d.get("conversation_id"), d.get("seq")) for d in self.documents.values()}
+        for index, document in enumerate(documents):
+            if document["_id"] in self.documents:
+                errors.append({"index": index, "code": DUPLICATE_KEY_ERROR, "keyPattern": {"_id": 1},
+                               "errmsg": "E11000 duplicate key error index: _id_ "})
+            elif (document.get("conversation_id"), document.get("seq")) in seqs:
+                errors.append({"index": index, "code": DUPLICATE_KEY_ERROR,
+                               "keyPattern": {"conversation_id": 1, "seq": 1},
+                               "errmsg": "E11000 duplicate key error index: conversation_id_1_seq_1"})
+            else:
+                self.documents[document["_id"]] = document
+                seqs.add((document.get("conversation_id"), document.get("seq")))
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [],
+                                  "nInserted": len(documents) - len(errors)})
+
+
+def message(seq: int) -> dict:
+    return {"conversation_id": "a:b", "seq": seq, "sender_id": "a", "receiver_id": "b",
+            "content": f"m{seq}", "timestamp": f"2024-01-01T00:00:{seq:02d}"}
+
+
+def make_writer(collection, tmp_path, mode="ack", retries=2):
+    writer = GroupCommitWriter(collection, mode=mode, max_batch=100, max_delay_ms=20, retries=retries,
+                               spill_path=str(tmp_path / "spill.{pid}.ndjson"))
+    seen = []
+
+    async def listener(documents):
+        seen.extend(document["seq"] for document in documents)
+
+    writer.add_listener(listener)
+    return writer, seen
+
+
+def read_ndjson(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json_util.loads(line) for line in f if line.strip()]
+
+
+def test_rejected_document_fails_alone_in_ack_mode(tmp_path):
+    async def run():
+        collection = StubCollection()
+        collection.documents["old"] = {**message(2), "_id": "old"}
+        writer, seen = make_writer(collection, tmp_path)
+        await writer.start()
+        results = await asyncio.gather(*(writer.write(message(seq)) for seq in (1, 2, 3)),
+                                       return_exceptions=True)
+        await writer.stop()
+        return collection, writer, seen, results
+
+    collection, writer, seen, results = asyncio.run(run())
+    assert results[0]["seq"] == 1 and results[2]["seq"] == 3
+    assert isinstance(results[1], WriteError)
+    assert sorted(seen) == [1, 3]
+    assert len(collection.documents) == 3
+    assert writer.metrics()["documents"] == 2
+    assert writer.metrics()["spilled"] == 0
+
+
+def test_rejected_document_is_set_aside_in_deliver_first_mode(tmp_path):
+    async def run():
+        collection = StubCollection()
+        collection.documents["old"] = {**message(2), "_id": "old"}
+        writer, seen = make_writer(collection, tmp_path, mode="deliver_first")
+        await writer.start()
+        for seq in (1, 2, 3):
+            await writer.write(message(seq))
+        await writer.stop()
+        return writer, seen
+
+    writer, seen = asyncio.run(run())
+    assert sorted(seen) == [1, 3]
+    assert not os.path.exists(writer.spill_path)
+    assert [document["seq"] for document in read_ndjson(f"{writer.spill_path}.rejected")] == [2]
+    assert writer.metrics()["rejected"] == 1
+
+
+def test_retry_after_partial_write_acknowledges_everything(tmp_path):
+    async def run():
+        collection = StubCollection(failures=1, partial=2)
+        writer, seen = make_writer(collection, tmp_path)
+        await writer.start()
+        await asyncio.gather(*(writer.write(message(seq)) for seq in (1, 2, 3)))
+        await writer.stop()
+        return collection, writer, seen
+
+    collection, writer, seen = asyncio.run(run())
+    assert sorted(seen) == [1, 2, 3]
+    assert len(collection.documents) == 3
+    assert writer.metrics()["retries"] == 1
+
+
+def test_unwritable_batch_is_spilled_in_deliver_first_mode(tmp_path):
+    async def run():
+        collection = StubCollection(failures=10)
+        writer, seen = make_writer(collection, tmp_path, mode="deliver_first", retries=1)
+        await writer.start()
+        for seq in (1, 2):
+            await writer.write(message(seq))
+        await writer.stop()
+        return writer, seen
+
+    writer, seen = asyncio.run(run())
+    assert seen == []
+    assert [document["seq"] for document in read_ndjson(writer.spill_path)] == [1, 2]
+
+
+def test_waiting_writer_gets_the_error_when_the_batch_cannot_be_written(tmp_path):
+    async def run():
+        writer, _ = make_writer(StubCollection(failures=10), tmp_path, retries=1)
+        await writer.start()
+        try:
+            with pytest.raises(AutoReconnect):
+                await writer.write(message(1))
+        finally:
+            await writer.stop()
+
+    asyncio.run(run())
+
+
+def test_replay_sets_unwritable_documents_aside(tmp_path):
+    async def run():
+        collection = StubCollection()
+        collection.documents["old"] = {**message(2), "_id": "old"}
+        already_written = {**message(1), "_id": ObjectId()}
+        collection.documents[already_written["_id"]] = already_written
+        writer, seen = make_writer(collection, tmp_path)
+        writer._append(writer.spill_path, [already_written, {**message(2), "_id": ObjectId()},
+                                           {**message(3), "_id": ObjectId()}])
+        await writer.start()
+        await writer.stop()
+        return collection, writer, seen
+
+    collection, writer, seen = asyncio.run(run())
+    assert not os.path.exists(writer.spill_path)
+    assert [document["seq"] for document in read_ndjson(f"{writer.spill_path}.rejected")] == [2]
+    assert sorted(seen) == [1, 3]
+    assert writer.metrics()["replayed"] == 2
+
+
+def test_replay_keeps_the_file_when_the_database_is_down(tmp_path):
+    async def run():
+        writer, seen = make_writer(StubCollection(failures=1), tmp_path)
+        writer._append(writer.spill_path, [{**message(1), "_id": ObjectId()}])
+        await writer.start()
+        await writer.stop()
+        return writer, seen
+
+    writer, seen = asyncio.run(run())
+    assert [document["seq"] for document in read_ndjson(writer.spill_path)] == [1]
+    assert seen == []
+
+
+def test_spill_files_of_exited_workers_are_replayed(tmp_path):
+    async def run():
+        collection = StubCollection()
+        writer, seen = make_writer(collection, tmp_path)
+        # No process has pid 2**22 + 1; pid_max is at most 2**22
+        writer._append(str(tmp_path / f"spill.{2 ** 22 + 1}.ndjson"), [{**message(1), "_id": ObjectId()}])
+        await writer.start()
+        await writer.stop()
+        return collection, seen
+
+    collection, seen = asyncio.run(run())
+    assert seen == [1]
+    assert len(collection.documents) == 1
+    assert os.listdir(tmp_path) == []
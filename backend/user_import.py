@@ -0,0 +1,129 @@
+import csv
+import json
+import logging
+import os
+from datetime import datetime
+from typing import AsyncIterator, List, Tuple
+
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+USER_IMPORT_BATCH_SIZE = int(os.getenv("USER_IMPORT_BATCH_SIZE", "500"))
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8").rstrip("\r")
+
+
+async def parse_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    row = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        row += 1
+        try:
+            yield row, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield row, ValueError(f"Invalid JSON: {e}")
+
+
+async def parse_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    header = None
+    row = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        row += 1
+        if len(values) != len(header):
+            yield row, ValueError(f"Expected {len(header)} columns, got {len(values)}")
+            continue
+        yield row, {name: value for name, value in zip(header, values) if value != ""}
+
+
+class UserImporter:
+    """Validates, hashes and inserts uploaded users in unordered batches.
+
+    Duplicate emails are detected by the unique index on ``users.email``
+    rather than a lookup per row; both in-database and in-upload duplicates
+    come back as ``duplicate`` rows in the report.
+    """
+
+    def __init__(self, users_collection, hasher, model, batch_size: int = USER_IMPORT_BATCH_SIZE):
+        self.users_collection = users_collection
+        self.hasher = hasher
+        self.model = model
+        self.batch_size = batch_size
+
+    async def run(self, rows: AsyncIterator[Tuple[int, object]]) -> dict:
+        report = {"created": 0, "duplicate": 0, "invalid": 0, "rows": []}
+        batch: List[Tuple[int, object]] = []
+        async for row, data in rows:
+            user = self._validate(row, data, report)
+            if user is not None:
+                batch.append((row, user))
+            if len(batch) >= self.batch_size:
+                await self._flush(batch, report)
+                batch = []
+        if batch:
+            await self._flush(batch, report)
+        report["rows"].sort(key=lambda result: result["row"])
+        return report
+
+    def _validate(self, row: int, data, report: dict):
+        if isinstance(data, Exception):
+            self._add(report, row, None, "invalid", error=str(data))
+            return None
+        if not isinstance(data, dict):
+            self._add(report, row, None, "invalid", error="Expected an object")
+            return None
+        try:
+            return self.model(**data)
+        except ValidationError as e:
+            errors = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            self._add(report, row, data.get("email"), "invalid", error=errors)
+            return None
+
+    async def _flush(self, batch: List[Tuple[int, object]], report: dict):
+        hashed = await self.hasher.hash_many([user.password for _, user in batch])
+        now = datetime.now().isoformat()
+        documents = []
+        for (_, user), hashed_password in zip(batch, hashed):
+            user_dict = user.dict()
+            user_dict["password"] = hashed_password
+            user_dict["created_at"] = now
+            documents.append(user_dict)
+
+        failed = {}
+        try:
+            await self.users_collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = error
+
+        for index, ((row, user), document) in enumerate(zip(batch, documents)):
+            error = failed.get(index)
+            if error is None:
+                self._add(report, row, user.email, "created", _id=str(document["_id"]))
+            elif error.get("code") == DUPLICATE_KEY_ERROR:
+                self._add(report, row, user.email, "duplicate", error="Email already registered")
+            else:
+                self._add(report, row, user.email, "invalid", error=error.get("errmsg", "Insert failed"))
+
+    @staticmethod
+    def _add(report: dict, row: int, email, status: str, **extra):
+        report[status] += 1
+        report["rows"].append({"row": row, "email": email, "status": status, **extra})
@@ -0,0 +1,162 @@
+"""WebSocket wire protocols.
+
+Version 1 is the original protocol: one JSON text frame per event. Clients
+that offer the ``chat.v2.msgpack`` subprotocol get version 2: binary
+MessagePack frames, each holding a list of events, so everything queued for a
+connection goes out in one frame. Inbound v2 frames are validated against the
+models below. Compression is permessage-deflate, negotiated by uvicorn
+(``--ws-per-message-deflate``) for either version.
+
+Events fanned out to many sockets are wrapped in ``SharedEvent`` so each
+protocol encodes them once, however many sockets they go to.
+"""
+from typing import Annotated, Dict, List, Literal, Optional, Union
+
+import msgpack
+import orjson
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+
+V2_SUBPROTOCOL = "chat.v2.msgpack"
+MAX_FRAME_EVENTS = 100
+MAX_MESSAGE_LENGTH = 10000
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class ChatFrame(BaseModel):
+    type: Literal["chat"]
+    recipient_id: str = Field(min_length=1, max_length=64)
+    message: str = Field(min_length=1, max_length=MAX_MESSAGE_LENGTH)
+
+
+class ReadFrame(BaseModel):
+    type: Literal["read"]
+    peer_id: str = Field(min_length=1, max_length=64)
+    up_to: Optional[str] = None
+
+
+class ResumeFrame(BaseModel):
+    type: Literal["resume"]
+    cursors: Dict[str, int] = {}
+    since: Optional[str] = None
+
+
+class FetchFrame(BaseModel):
+    type: Literal["fetch"]
+    conversation_id: str
+    from_seq: int
+    to_seq: int
+
+
+class RoomFrame(BaseModel):
+    type: Literal["room"]
+    room_id: str = Field(min_length=1, max_length=64)
+    message: str = Field(min_length=1, max_length=MAX_MESSAGE_LENGTH)
+
+
+class TypingFrame(BaseModel):
+    type: Literal["typing"]
+    peer_id: str = Field(min_length=1, max_length=64)
+    typing: bool = True
+
+
+class PresenceFrame(BaseModel):
+    type: Literal["presence"]
+    peer_ids: List[str] = Field(min_length=1, max_length=100)
+    status: Literal["online", "away"]
+
+
+class HeartbeatFrame(BaseModel):
+    type: Literal["heartbeat"]
+
+
+class PongFrame(BaseModel):
+    type: Literal["pong"]
+    ts: Optional[float] = None
+
+
+InboundFrame = Annotated[
+    Union[ChatFrame, ReadFrame, RoomFrame, TypingFrame, PresenceFrame, ResumeFrame, FetchFrame,
+          HeartbeatFrame, PongFrame],
+    Field(discriminator="type")
+]
+_inbound_frames = TypeAdapter(List[InboundFrame])
+_packer = msgpack.Packer()
+
+
+def _typed(event: dict) -> dict:
+    # v1 chat deliveries carry no type; v2 clients always get one
+    return event if "type" in event else {"type": "message", **event}
+
+
+class SharedEvent(dict):
+    """An outbound event with its encodings cached; treat it as read-only."""
+
+    __slots__ = ("_text", "_packed")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._text = None
+        self._packed = None
+
+    def as_text(self) -> str:
+        if self._text is None:
+            self._text = orjson.dumps(self).decode()
+        return self._text
+
+    def as_msgpack(self) -> bytes:
+        if self._packed is None:
+            self._packed = _packer.pack(_typed(self))
+        return self._packed
+
+
+class JsonCodec:
+    """Protocol v1: one JSON text frame per event."""
+
+    version = 1
+    subprotocol = None
+
+    async def receive(self, websocket) -> List[dict]:
+        return [await websocket.receive_json()]
+
+    async def send(self, websocket, events: List[dict]):
+        for event in events:
+            await websocket.send_text(event.as_text() if isinstance(event, SharedEvent) else orjson.dumps(event).decode())
+
+
+class MsgpackCodec:
+    """Protocol v2: binary MessagePack frames carrying a list of events."""
+
+    version = 2
+    subprotocol = V2_SUBPROTOCOL
+
+    async def receive(self, websocket) -> List[dict]:
+        try:
+            payload = msgpack.unpackb(await websocket.receive_bytes(), raw=False)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ProtocolError(f"Invalid MessagePack frame: {e}")
+        if isinstance(payload, dict):
+            payload = [payload]
+        if not isinstance(payload, list) or len(payload) > MAX_FRAME_EVENTS:
+            raise ProtocolError(f"A frame holds one event or a list of at most {MAX_FRAME_EVENTS}")
+        try:
+            frames = _inbound_frames.validate_python(payload)
+        except ValidationError as e:
+            raise ProtocolError(f"Invalid event: {e.errors()[0]['msg']}")
+        return [frame.model_dump(exclude_none=True) for frame in frames]
+
+    async def send(self, websocket, events: List[dict]):
+        # A MessagePack array is its header followed by the packed items, so
+        # shared events are spliced in from their cached encoding
+        await websocket.send_bytes(_packer.pack_array_header(len(events)) + b"".join(
+            event.as_msgpack() if isinstance(event, SharedEvent) else _packer.pack(_typed(event)) for event in events
+        ))
+
+
+def negotiate(websocket) -> Union[JsonCodec, MsgpackCodec]:
+    """Pick the codec from the subprotocols the client offered."""
+    if V2_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        return MsgpackCodec()
+    return JsonCodec()